@@ -1,4 +1,5 @@
 from django.contrib import admin
+from django.db.models import Case, IntegerField, Value, When
 
 from .models import Store
 from .models import StoreContact
@@ -89,8 +90,10 @@ class ProductPropertyInline(admin.TabularInline):
 
 class ProductAdmin(admin.ModelAdmin):
     model = Product
-    list_display = ('name', 'code', 'group', 'store', 'category', 'cost', 'count', 'blocked', 'description',)
-    list_filter = ('blocked', 'category',)
+    list_display = (
+        'name', 'code', 'group', 'store', 'category', 'cost', 'count', 'blocked', 'is_visible', 'description',
+    )
+    list_filter = ('blocked', 'is_visible', 'category',)
     fieldsets = (
         (None, {
             'fields': ('name', 'code', 'group', 'store', 'category', 'cost', 'count', 'description',)
@@ -172,12 +175,16 @@ class OrderAdmin(admin.ModelAdmin):
         elif s == 'Заказ отменен':
             return f'<div style="width:100%%; height:100%%; background-color:red;">{s}</div>'
         return s
+    status.admin_order_field = Case(
+        *[When(state=state, then=Value(index)) for index, (state, label) in enumerate(Order.STATES)],
+        output_field=IntegerField()
+    )
 
     model = Order
     list_display = (
         'store', 'status', 'user', 'address', 'amount', 'paid', 'canceled', 'completed', 'delivered', 'created_time',
     )
-    list_filter = ('paid', 'canceled', 'completed', 'delivered',)
+    list_filter = ('state', 'paid', 'canceled', 'completed', 'delivered',)
     fieldsets = (
         (None, {
             'fields': (
@@ -0,0 +1,125 @@
+import datetime
+
+from django.db import transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Q, Sum
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from .models import Order
+from .models import OrderPosition
+from .models import StoreSalesDay
+from .models import ProductSalesDay
+from .models import StaleSalesDay
+
+# заказ считается продажей, если он оплачен и не отменен
+SOLD = Q(paid=True, canceled=False)
+
+
+def day_bounds(day):
+    """Start and end of a local calendar day, so the range filter can use the created_time indexes."""
+    start = timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+    return start, start + datetime.timedelta(days=1)
+
+
+def store_sales(orders):
+    """StoreSalesDay rows aggregated from the `orders` queryset, two GROUP BY queries."""
+    rows = orders.filter(store__isnull=False).values('store_id', day=TruncDate('created_time')).annotate(
+        sold=Count('id', filter=SOLD),
+        revenue=Sum('amount', filter=SOLD),
+        canceled_orders=Count('id', filter=Q(canceled=True)),
+        delivered_orders=Count('id', filter=Q(delivered=True, canceled=False)),
+    ).order_by()
+    units = OrderPosition.objects.filter(order__in=orders.filter(SOLD)).values(
+        'order__store_id', day=TruncDate('order__created_time')
+    ).annotate(units=Sum('count')).order_by()
+    units = {(row['order__store_id'], row['day']): row['units'] for row in units}
+    return [
+        StoreSalesDay(
+            store_id=row['store_id'], date=row['day'], orders=row['sold'], revenue=row['revenue'] or 0,
+            units=units.get((row['store_id'], row['day']), 0), canceled_orders=row['canceled_orders'],
+            delivered_orders=row['delivered_orders'],
+        )
+        for row in rows if row['sold'] or row['canceled_orders']
+    ]
+
+
+def product_sales(orders):
+    """ProductSalesDay rows aggregated from the positions of the `orders` queryset."""
+    sold = Q(order__paid=True, order__canceled=False)
+    # позиции без сохраненной цены оцениваются по текущей цене товара
+    revenue = ExpressionWrapper(
+        F('count') * Coalesce('cost', 'product__cost'), output_field=DecimalField(max_digits=14, decimal_places=2)
+    )
+    rows = OrderPosition.objects.filter(order__in=orders, product__isnull=False, order__store__isnull=False).values(
+        'order__store_id', 'product_id', day=TruncDate('order__created_time')
+    ).annotate(
+        sold=Count('order', distinct=True, filter=sold),
+        revenue=Sum(revenue, filter=sold),
+        units=Sum('count', filter=sold),
+        canceled_units=Sum('count', filter=Q(order__canceled=True)),
+    ).order_by()
+    return [
+        ProductSalesDay(
+            store_id=row['order__store_id'], product_id=row['product_id'], date=row['day'], orders=row['sold'],
+            revenue=row['revenue'] or 0, units=row['units'] or 0, canceled_units=row['canceled_units'] or 0,
+        )
+        for row in rows if row['sold'] or row['canceled_units']
+    ]
+
+
+def rebuild_sales(orders, scope):
+    """
+    Replaces the rollup rows matching the `scope` condition with the ones aggregated from `orders`,
+    which must be all orders of the scope's store days.
+    """
+    with transaction.atomic():
+        StoreSalesDay.objects.filter(scope).delete()
+        ProductSalesDay.objects.filter(scope).delete()
+        StoreSalesDay.objects.bulk_create(store_sales(orders), batch_size=1000)
+        ProductSalesDay.objects.bulk_create(product_sales(orders), batch_size=1000)
+
+
+def mark_sales_stale(orders):
+    """
+    Marks the store days of `orders` (Order instances) stale after they were changed. The marks are written
+    when the transaction commits, so the worker that rebuilds the day always sees the change.
+    """
+    days = {(order.store_id, timezone.localdate(order.created_time)) for order in orders if order.store_id}
+    if days:
+        transaction.on_commit(lambda: StaleSalesDay.objects.bulk_create(
+            [StaleSalesDay(store_id=store_id, date=day) for store_id, day in days], ignore_conflicts=True
+        ))
+
+
+def rebuild_stale_sales(limit=100):
+    """
+    Rebuilds up to `limit` stale store days, oldest marks first, returns (rebuilt, failed). Each day is rebuilt
+    in the transaction that deletes its mark: the locked mark keeps other workers off the day, and a change
+    committed meanwhile marks the day again once the rebuild commits.
+    """
+    rebuilt = failed = 0
+    failed_ids = []
+    while rebuilt + failed < limit:
+        stale = None
+        try:
+            with transaction.atomic():
+                stale = StaleSalesDay.objects.select_for_update(skip_locked=True).exclude(
+                    id__in=failed_ids
+                ).order_by('marked_time', 'id').first()
+                if stale is None:
+                    break
+                stale.delete()
+                start, end = day_bounds(stale.date)
+                rebuild_sales(
+                    Order.objects.filter(store_id=stale.store_id, created_time__gte=start, created_time__lt=end),
+                    Q(store_id=stale.store_id, date=stale.date)
+                )
+        except Exception:
+            if stale is None:
+                raise
+            # отметка остается после отката, день пересчитает следующий проход
+            failed_ids.append(stale.id)
+            failed += 1
+            continue
+        rebuilt += 1
+    return rebuilt, failed
@@ -0,0 +1,34 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+VERSION_KEY = 'marketplace:version:%s'
+
+
+def get_cache():
+    """
+    Cache backend used for table versions and cached responses: the Django cache named by
+    settings.MARKETPLACE_CACHE ("default" if not set). Local memory is enough for tests,
+    in production it should be a shared backend such as Redis.
+    """
+    return caches[getattr(settings, 'MARKETPLACE_CACHE', 'default')]
+
+
+def get_versions(models):
+    """
+    Version stamps of the given tables. A stamp is the time (ns) of the last change of the table, so it can
+    serve both as a cache key component and as a modification time.
+    """
+    cache = get_cache()
+    keys = {VERSION_KEY % model._meta.label_lower: model for model in models}
+    versions = cache.get_many(keys.keys())
+    missing = {key: time.time_ns() for key in keys if key not in versions}
+    if missing:
+        cache.set_many(missing, timeout=None)
+        versions.update(missing)
+    return {keys[key]._meta.label_lower: versions[key] for key in keys}
+
+
+def touch(*models):
+    get_cache().set_many({VERSION_KEY % model._meta.label_lower: time.time_ns() for model in models}, timeout=None)
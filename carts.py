@@ -0,0 +1,131 @@
+import time
+from abc import ABC, abstractmethod
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import CartPosition
+
+CART_KEY = 'marketplace:cart:%s'
+
+
+class CartStorage(ABC):
+    """
+    Storage of anonymous carts keyed by tmp_user_code. A cart is {product id: count}.
+
+    Carts of logged in users always live in CartPosition. An anonymous cart is written to CartPosition
+    only by `persist`, when its owner logs in (CartPositionViewSet.sync).
+    """
+    # позиции корзины хранятся строками CartPosition и доступны через queryset
+    database = False
+
+    def __init__(self):
+        self.timeout = getattr(settings, 'MARKETPLACE_CART_TTL', 30 * 24 * 60 * 60)
+
+    @abstractmethod
+    def get(self, code):
+        """Returns the cart, an empty dict if there is none or it expired."""
+
+    @abstractmethod
+    def apply_counts(self, code, counts):
+        """Sets product counts of the cart, 0 removes the product."""
+
+    @abstractmethod
+    def clear(self, code):
+        """Deletes the cart."""
+
+    def persist(self, code, user):
+        """Merges the cart into the CartPosition rows of `user` (see CartPositionQuerySet.merge_counts)."""
+        with transaction.atomic():
+            CartPosition.objects.filter(user=user).merge_counts(self.get(code), user=user)
+            self.clear(code)
+
+
+class DatabaseCartStorage(CartStorage):
+    """Anonymous carts as CartPosition rows with tmp_user_code."""
+    database = True
+
+    def get_queryset(self, code):
+        return CartPosition.objects.filter(tmp_user_code=code, user__isnull=True)
+
+    def get(self, code):
+        counts = dict()
+        for product_id, count in self.get_queryset(code).values_list('product_id', 'count'):
+            counts[product_id] = counts.get(product_id, 0) + count
+        return counts
+
+    def apply_counts(self, code, counts):
+        self.get_queryset(code).apply_counts(counts, tmp_user_code=code)
+
+    def clear(self, code):
+        self.get_queryset(code).delete()
+
+
+class RedisCartStorage(CartStorage):
+    """
+    Anonymous carts as Redis hashes (product id -> count) expiring `MARKETPLACE_CART_TTL` seconds after the last
+    change. The server is `MARKETPLACE_CART_REDIS_URL`.
+    """
+    clients = dict()
+
+    def __init__(self):
+        super(RedisCartStorage, self).__init__()
+        url = getattr(settings, 'MARKETPLACE_CART_REDIS_URL', 'redis://localhost:6379/0')
+        if url not in self.clients:
+            import redis
+            self.clients[url] = redis.Redis.from_url(url)
+        self.client = self.clients[url]
+
+    def get(self, code):
+        return {int(product_id): int(count) for product_id, count in self.client.hgetall(CART_KEY % code).items()}
+
+    def apply_counts(self, code, counts):
+        key = CART_KEY % code
+        changed = {product_id: count for product_id, count in counts.items() if count > 0}
+        removed = [product_id for product_id in counts if product_id not in changed]
+        pipeline = self.client.pipeline()
+        if changed:
+            pipeline.hset(key, mapping=changed)
+        if removed:
+            pipeline.hdel(key, *removed)
+        pipeline.expire(key, self.timeout)
+        pipeline.execute()
+
+    def clear(self, code):
+        self.client.delete(CART_KEY % code)
+
+
+class MemoryCartStorage(CartStorage):
+    """Process local storage with the same expiration rules, for tests and development."""
+    carts = dict()
+
+    def get(self, code):
+        counts, expires = self.carts.get(code, (None, 0))
+        if expires < time.monotonic():
+            self.carts.pop(code, None)
+            return dict()
+        return dict(counts)
+
+    def apply_counts(self, code, counts):
+        cart = self.get(code)
+        for product_id, count in counts.items():
+            if count > 0:
+                cart[product_id] = count
+            else:
+                cart.pop(product_id, None)
+        self.carts[code] = (cart, time.monotonic() + self.timeout)
+
+    def clear(self, code):
+        self.carts.pop(code, None)
+
+
+CART_STORAGES = {
+    'database': DatabaseCartStorage,
+    'redis': RedisCartStorage,
+    'memory': MemoryCartStorage,
+}
+
+
+def get_cart_storage():
+    """Storage of anonymous carts named by settings.MARKETPLACE_CART_STORAGE ("database" if not set)."""
+    return CART_STORAGES[getattr(settings, 'MARKETPLACE_CART_STORAGE', 'database')]()
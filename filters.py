@@ -1,3 +1,15 @@
+from decimal import Decimal, InvalidOperation
+
+from django.db.models import Exists, OuterRef, Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+
+from .models import Category
+from .models import ProductProperty
+
+from .search import get_search_backend
+
+
 def query_params_filter(request, queryset, key_fields, char_fields):
     if len(request.query_params) > 0:
         for p in request.query_params:
@@ -10,3 +22,62 @@ def query_params_filter(request, queryset, key_fields, char_fields):
             elif p.replace("ex_", "") in char_fields:
                 queryset = queryset.exclude(**{'%s__icontains' % p: request.query_params.get(p)})
     return queryset
+
+
+def query_params_range_filter(request, queryset, range_fields):
+    for p, field in range_fields.items():
+        for suffix, lookup in (('min', 'gte'), ('max', 'lte')):
+            value = request.query_params.get(f'{p}_{suffix}')
+            if value is None:
+                continue
+            try:
+                value = Decimal(value)
+            except InvalidOperation:
+                raise ValidationError({f'{p}_{suffix}': 'Значение должно быть числом'})
+            queryset = queryset.filter(**{'%s__%s' % (field, lookup): value})
+    return queryset
+
+
+def category_subtree_filter(request, queryset, param, field='category'):
+    """
+    ?<param>=<id> keeps rows whose category is that category or any of its subcategories
+    (prefix match on the indexed Category.path).
+    """
+    category_ids = request.query_params.getlist(param)
+    if not category_ids:
+        return queryset
+    if not all(category_id.isdigit() for category_id in category_ids):
+        raise ValidationError({param: 'Идентификатор категории должен представлять целое число'})
+    condition = Q(pk__in=[])
+    for path in Category.objects.filter(id__in=category_ids).values_list('path', flat=True):
+        condition |= Q(**{f'{field}__path__startswith': path})
+    return queryset.filter(condition)
+
+
+def property_filter(request, queryset, param='prop'):
+    """
+    ?<param>[<name>]=<value> keeps products having that property value. Repeated values of one property
+    are alternatives, different properties must all match: ?prop[color]=red&prop[color]=blue&prop[size]=L.
+    """
+    for key in request.query_params:
+        if not key.startswith(f'{param}[') or not key.endswith(']') or len(key) == len(param) + 2:
+            continue
+        queryset = queryset.filter(Exists(ProductProperty.objects.filter(
+            product=OuterRef('pk'), property_name=key[len(param) + 1:-1],
+            property_value__in=request.query_params.getlist(key)
+        )))
+    return queryset
+
+
+class ProductSearchFilter(BaseFilterBackend):
+    """
+    Full-text search over product name, keywords and description ordered by relevance.
+    An explicit ?ordering= (OrderingFilter goes after this backend) overrides the relevance order.
+    """
+    search_param = 'search'
+
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param, '').strip()
+        if not query:
+            return queryset
+        return get_search_backend().search(queryset, query)
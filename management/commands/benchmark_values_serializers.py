@@ -0,0 +1,108 @@
+import datetime
+import statistics
+import time
+import uuid
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory
+from django.utils import timezone
+from rest_framework.request import Request
+
+from marketplace.models import Store
+from marketplace.models import Category
+from marketplace.models import Product
+from marketplace.models import ProductPhoto
+from marketplace.models import Discount
+from marketplace.serializers import StoreSerializer
+from marketplace.serializers import ProductSerializer
+from marketplace.values_serializers import StoreValuesSerializer
+from marketplace.values_serializers import ProductValuesSerializer
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает время отрисовки страницы списка товаров и магазинов обычными сериализаторами и через ' \
+           'values() (values_serializers.py), вместе с запросами к базе. Данные создаются во временной ' \
+           'транзакции, которая откатывается в конце.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100, help='Количество строк на странице')
+        parser.add_argument('--repeat', type=int, default=20, help='Количество замеров, берется медиана')
+        parser.add_argument('--host', default=next(
+            (host for host in settings.ALLOWED_HOSTS if host != '*' and not host.startswith('.')), 'localhost'
+        ), help='Хост запроса, от которого строятся ссылки на файлы')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            stores, products = self.create_catalog(options['rows'])
+            self.compare('Товары', ProductSerializer, ProductValuesSerializer, products, options)
+            self.compare('Магазины', StoreSerializer, StoreValuesSerializer, stores, options)
+            transaction.set_rollback(True)
+
+    @staticmethod
+    def create_catalog(rows):
+        prefix = f'benchmark-{uuid.uuid4().hex[:8]}'
+        user = get_user_model().objects.create_user(username=prefix)
+        category = Category.objects.create(name=prefix, category=Category.objects.create(name=f'{prefix}-root'),
+                                           moderator_confirmed=True)
+        Store.objects.bulk_create([
+            Store(user=user, name=f'{prefix}-{index}', logo=f'stores/{index}/logo.png', moderator_confirmed=True)
+            for index in range(rows)
+        ])
+        stores = list(Store.objects.filter(name__startswith=f'{prefix}-'))
+        Product.objects.bulk_create([
+            Product(store=stores[index], category=category, name=f'{prefix}-{index}', code=str(index),
+                    cost=Decimal(100 + index), count=10, description='описание товара ' * 10)
+            for index in range(rows)
+        ])
+        products = list(Product.objects.filter(name__startswith=f'{prefix}-'))
+        ProductPhoto.objects.bulk_create([
+            ProductPhoto(product=product, img=f'products/{product.id}/{index}.png')
+            for product in products for index in range(2)
+        ])
+        now = timezone.now()
+        Discount.objects.bulk_create([
+            Discount(user=user, product=product, discount_value=Decimal(10),
+                     date_start=now - datetime.timedelta(days=1), date_end=now + datetime.timedelta(days=1))
+            for product in products[::3]
+        ])
+        return (Store.objects.filter(id__in=[store.id for store in stores]).order_by('id'),
+                Product.objects.filter(id__in=[product.id for product in products]).order_by('id'))
+
+    def compare(self, title, serializer_class, values_serializer_class, queryset, options):
+        factory = RequestFactory()
+
+        # контекст создается на каждый замер, чтобы не переиспользовать загруженные скидки (get_pricing)
+        def context():
+            return {'request': Request(factory.get('/', HTTP_HOST=options['host']))}
+
+        def regular():
+            rows = queryset
+            if hasattr(serializer_class, 'setup_eager_loading'):
+                rows = serializer_class.setup_eager_loading(rows)
+            return serializer_class(rows, many=True, context=context()).data
+
+        def values():
+            values_serializer = values_serializer_class(context=context())
+            return values_serializer.to_representation(values_serializer.get_queryset(queryset))
+
+        regular_time = self.measure(regular, options['repeat'])
+        values_time = self.measure(values, options['repeat'])
+        self.stdout.write(self.style.SUCCESS(
+            f'{title}, {options["rows"]} строк: сериализаторы {regular_time * 1000:.1f} мс, '
+            f'values() {values_time * 1000:.1f} мс, ускорение в {regular_time / values_time:.1f} раза'
+        ))
+
+    @staticmethod
+    def measure(render, repeat):
+        # первый проход прогревает скомпилированные отображения полей
+        render()
+        timings = list()
+        for attempt in range(repeat):
+            started = time.perf_counter()
+            render()
+            timings.append(time.perf_counter() - started)
+        return statistics.median(timings)
@@ -0,0 +1,12 @@
+from marketplace.management.workers import WorkerCommand
+from marketplace.payments import process_payment_notifications
+
+
+class Command(WorkerCommand):
+    help = 'Обрабатывает сохраненные уведомления платежного сервиса: отмечает заказы оплаченными, рассылает ' \
+           'уведомления, пересоздает отмененные платежи. Запускается по расписанию (cron) или постоянно с --loop.'
+    batch_size_help = 'Количество уведомлений, обрабатываемых за проход'
+
+    def process(self, options):
+        processed, failed = process_payment_notifications(options['batch_size'])
+        return processed or failed, f'Обработано уведомлений: {processed}, неудачных попыток: {failed}'
@@ -0,0 +1,13 @@
+from marketplace.management.workers import WorkerCommand
+from marketplace.payments import process_payment_outbox
+
+
+class Command(WorkerCommand):
+    help = 'Создает у платежного сервиса платежи заказов из очереди PaymentOutbox. Запускается по расписанию ' \
+           '(cron) или постоянно с --loop.'
+    batch_size = 50
+    batch_size_help = 'Количество платежей, обрабатываемых за проход'
+
+    def process(self, options):
+        created, failed = process_payment_outbox(options['batch_size'])
+        return created or failed, f'Создано платежей: {created}, неудачных попыток: {failed}'
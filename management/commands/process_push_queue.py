@@ -0,0 +1,51 @@
+from django.utils import timezone
+
+from marketplace.models import PushNotification
+from marketplace.management.workers import WorkerCommand
+from marketplace.notifications import process_push_queue
+
+
+def percentile(values, share):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+class Command(WorkerCommand):
+    help = 'Отправляет push-уведомления из очереди PushNotification пачками из пула потоков и печатает ' \
+           'пропускную способность и задержки. Запускается по расписанию (cron) или постоянно с --loop.'
+    batch_size_help = 'Количество уведомлений за проход'
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--workers', type=int, default=8, help='Количество потоков отправки')
+        parser.add_argument('--requeue-dead', action='store_true',
+                            help='Вернуть в очередь недоставленные уведомления перед отправкой')
+
+    def handle(self, *args, **options):
+        if options['requeue_dead']:
+            requeued = PushNotification.objects.filter(status=PushNotification.DEAD).update(
+                status=PushNotification.PENDING, attempts=0, next_attempt_time=timezone.now()
+            )
+            self.stdout.write(f'Возвращено в очередь: {requeued}')
+        super(Command, self).handle(*args, **options)
+
+    def process(self, options):
+        metrics = process_push_queue(options['batch_size'], options['workers'])
+        if not metrics['send_latency']:
+            return False, 'Очередь пуста'
+        return True, self.report(metrics)
+
+    def report(self, metrics):
+        count = len(metrics['send_latency'])
+        rate = count / metrics['seconds'] if metrics['seconds'] else 0
+        send_latency = sum(metrics['send_latency']) / count * 1000
+        queue_latency = metrics['queue_latency']
+        queue_average = sum(queue_latency) / len(queue_latency) if queue_latency else 0
+        return (
+            f'Отправлено: {metrics["sent"]}, повтор: {metrics["retried"]}, не доставлено: {metrics["dead"]}; '
+            f'{rate:.0f} уведомлений/с; отправка: в среднем {send_latency:.0f} мс, '
+            f'p95 {percentile(metrics["send_latency"], 0.95) * 1000:.0f} мс; '
+            f'ожидание в очереди: в среднем {queue_average:.1f} с, p95 {percentile(queue_latency, 0.95):.1f} с'
+        )
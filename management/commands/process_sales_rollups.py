@@ -0,0 +1,13 @@
+from marketplace.management.workers import WorkerCommand
+from marketplace.analytics import rebuild_stale_sales
+
+
+class Command(WorkerCommand):
+    help = 'Пересчитывает дневную статистику продаж (StoreSalesDay, ProductSalesDay) за дни, отмеченные ' \
+           'устаревшими (StaleSalesDay) при изменении заказов. Запускается по расписанию (cron) или постоянно с --loop.'
+    batch_size_help = 'Количество дней, пересчитываемых за проход'
+    interval = 5
+
+    def process(self, options):
+        rebuilt, failed = rebuild_stale_sales(options['batch_size'])
+        return rebuilt or failed, f'Пересчитано дней: {rebuilt}, неудачных попыток: {failed}'
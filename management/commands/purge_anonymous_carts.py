@@ -0,0 +1,40 @@
+import datetime
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from marketplace.models import CartPosition
+
+
+class Command(BaseCommand):
+    help = 'Удаляет брошенные анонимные корзины (позиции без пользователя), которые не менялись дольше --days ' \
+           'дней. Удаление идет пачками по --batch-size строк, чтобы не держать долгих блокировок. ' \
+           'Запускается по расписанию (cron).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=getattr(settings, 'MARKETPLACE_CART_PURGE_DAYS', 30),
+                            help='Возраст корзины в днях, после которого она считается брошенной')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Количество строк, удаляемых за раз')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - datetime.timedelta(days=options['days'])
+        anonymous = CartPosition.objects.filter(user__isnull=True)
+        # корзина брошена, только если в ней не менялась ни одна позиция
+        fresh = anonymous.filter(tmp_user_code=OuterRef('tmp_user_code'), updated_time__gte=cutoff)
+        stale = anonymous.filter(updated_time__lt=cutoff).exclude(Exists(fresh)).order_by('id')
+
+        started = time.monotonic()
+        deleted = 0
+        while True:
+            ids = list(stale.values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            deleted += CartPosition.objects.filter(id__in=ids).delete()[0]
+        elapsed = time.monotonic() - started
+        rate = deleted / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Удалено позиций корзин: {deleted} за {elapsed:.1f} с ({rate:.0f} строк/с)'
+        ))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.models import Category
+from marketplace.caching import touch
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает материализованные пути (Category.path) всего дерева категорий'
+
+    def handle(self, *args, **options):
+        categories = {category.id: category for category in Category.objects.only('id', 'category_id', 'path')}
+        paths = dict()
+
+        def get_path(category, visited=()):
+            if category.id not in paths:
+                parent = categories.get(category.category_id)
+                if parent is None or parent.id in visited:
+                    paths[category.id] = f'{category.id}/'
+                else:
+                    paths[category.id] = f'{get_path(parent, visited + (category.id,))}{category.id}/'
+            return paths[category.id]
+
+        changed = list()
+        for category in categories.values():
+            path = get_path(category)
+            if category.path != path:
+                category.path = path
+                changed.append(category)
+        Category.objects.bulk_update(changed, ['path'], batch_size=1000)
+        if changed:
+            touch(Category)
+        self.stdout.write(self.style.SUCCESS(f'Обновлено путей категорий: {len(changed)}'))
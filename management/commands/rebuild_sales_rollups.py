@@ -0,0 +1,44 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min, Q
+from django.utils import timezone
+
+from marketplace.models import Order
+from marketplace.analytics import day_bounds
+from marketplace.analytics import rebuild_sales
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает дневную статистику продаж магазинов и товаров (StoreSalesDay, ProductSalesDay) ' \
+           'по заказам с --since по --until. Без --since пересчитывается вся история. Расчет идет отрезками ' \
+           'по --chunk-days дней, каждый в своей транзакции.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=datetime.date.fromisoformat, help='Первый день, ГГГГ-ММ-ДД')
+        parser.add_argument('--until', type=datetime.date.fromisoformat, help='Последний день, ГГГГ-ММ-ДД')
+        parser.add_argument('--chunk-days', type=int, default=31, help='Количество дней, пересчитываемых за раз')
+
+    def handle(self, *args, **options):
+        until = options['until'] or timezone.localdate()
+        since = options['since']
+        if since is None:
+            first = Order.objects.aggregate(first=Min('created_time'))['first']
+            since = timezone.localdate(first) if first else until
+        if since > until:
+            raise CommandError('--since не может быть позже --until')
+
+        started = time.monotonic()
+        day = since
+        while day <= until:
+            end = min(day + datetime.timedelta(days=options['chunk_days'] - 1), until)
+            rebuild_sales(
+                Order.objects.filter(created_time__gte=day_bounds(day)[0], created_time__lt=day_bounds(end)[1]),
+                Q(date__gte=day, date__lte=end)
+            )
+            self.stdout.write(f'{day} - {end}')
+            day = end + datetime.timedelta(days=1)
+        self.stdout.write(self.style.SUCCESS(
+            f'Статистика продаж пересчитана с {since} по {until} за {time.monotonic() - started:.1f} с'
+        ))
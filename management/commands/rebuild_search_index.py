@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Создает полнотекстовый индекс товаров и заново заполняет его всеми товарами'
+
+    def handle(self, *args, **options):
+        get_search_backend().rebuild()
+        self.stdout.write(self.style.SUCCESS('Поисковый индекс товаров перестроен'))
@@ -0,0 +1,34 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from marketplace.models import Product
+from marketplace.models import Discount
+from marketplace.pricing import refresh_effective_costs
+from marketplace.caching import touch
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает цены товаров со скидкой, у которых начало или окончание скидки наступило за последние ' \
+           'N минут. Запускается по расписанию (cron) с интервалом не больше --minutes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minutes', type=int, default=15,
+                            help='Окно в минутах, за которое ищутся начавшиеся и закончившиеся скидки')
+        parser.add_argument('--all', action='store_true', help='Пересчитать цены всех товаров')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        products = Product.objects.all()
+        if not options['all']:
+            since = now - datetime.timedelta(minutes=options['minutes'])
+            discounts = Discount.objects.filter(
+                Q(date_start__gt=since, date_start__lte=now) | Q(date_end__gt=since, date_end__lte=now)
+            )
+            products = products.filter(id__in=discounts.values('product_id'))
+        updated = refresh_effective_costs(products, now)
+        if updated:
+            touch(Product)
+        self.stdout.write(self.style.SUCCESS(f'Обновлено цен: {updated}'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.models import Order
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает состояние всех заказов (поле Order.state) по флагам оплаты, отмены, сборки и доставки'
+
+    def handle(self, *args, **options):
+        updated = Order.objects.all().refresh_state()
+        self.stdout.write(self.style.SUCCESS(f'Изменено состояние заказов: {updated}'))
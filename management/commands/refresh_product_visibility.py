@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.models import Product
+from marketplace.caching import touch
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает видимость всех товаров в каталоге (флаг Product.is_visible)'
+
+    def handle(self, *args, **options):
+        updated = Product.objects.all().refresh_visibility()
+        if updated:
+            touch(Product)
+        self.stdout.write(self.style.SUCCESS(f'Изменена видимость товаров: {updated}'))
@@ -0,0 +1,34 @@
+import time
+from abc import ABC, abstractmethod
+
+from django.core.management.base import BaseCommand
+
+
+class WorkerCommand(BaseCommand, ABC):
+    """
+    Command processing a queue in batches: one pass by default (cron), or passes until stopped with --loop,
+    pausing --interval seconds after a pass that found nothing to do.
+    """
+    batch_size = 100
+    batch_size_help = 'Количество записей, обрабатываемых за проход'
+    interval = 1
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=self.batch_size, help=self.batch_size_help)
+        parser.add_argument('--loop', action='store_true', help='Работать постоянно, опрашивая очередь')
+        parser.add_argument('--interval', type=float, default=self.interval,
+                            help='Пауза между проходами в секундах (с --loop)')
+
+    @abstractmethod
+    def process(self, options):
+        """Runs one pass, returns whether it found any work and the line reporting it."""
+
+    def handle(self, *args, **options):
+        while True:
+            done, report = self.process(options)
+            if done or not options['loop']:
+                self.stdout.write(self.style.SUCCESS(report))
+            if not options['loop']:
+                break
+            if not done:
+                time.sleep(options['interval'])
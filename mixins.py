@@ -0,0 +1,142 @@
+import hashlib
+import json
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework.response import Response
+
+from .caching import get_cache, get_versions
+
+from .pagination import KeysetPagination
+
+RESPONSE_KEY = 'marketplace:response:%s'
+
+
+def request_signature(request):
+    """Normalized URL of a request: scheme, host, path and query params sorted by name and value."""
+    params = sorted((key, sorted(request.query_params.getlist(key))) for key in request.query_params)
+    return [request.scheme, request.get_host(), request.path, params]
+
+
+class EagerLoadingMixin:
+    """
+    Applies the select_related/prefetch_related/annotation plan declared by the serializer
+    (`setup_eager_loading`) to the queryset of the actions that render it, so a list page costs
+    a fixed number of queries whatever its size.
+    """
+    eager_loading_actions = ['list', 'retrieve']
+
+    def filter_queryset(self, queryset):
+        queryset = super(EagerLoadingMixin, self).filter_queryset(queryset)
+        serializer_class = self.get_serializer_class()
+        if self.action in self.eager_loading_actions and hasattr(serializer_class, 'setup_eager_loading'):
+            # поля, отброшенные ?fields= / ?expand=, не требуют загрузки связанных данных
+            fields = set(self.get_serializer().fields)
+            queryset = serializer_class.setup_eager_loading(queryset, fields)
+        return queryset
+
+
+class ResponseCacheMixin:
+    """
+    Caches the response data of read-only actions keyed by the normalized URL (host, path and sorted query
+    params) and the versions of `cache_models`. Any change of those tables (see signals.py) changes their
+    versions, so stale entries are never read again and expire by `cache_timeout`.
+    """
+    cache_models = []
+    cache_timeout = 15 * 60
+
+    def get_response_cache_key(self, request):
+        raw = json.dumps(request_signature(request) + [sorted(get_versions(self.cache_models).items())])
+        return RESPONSE_KEY % hashlib.md5(raw.encode()).hexdigest()
+
+    def get_cached_response(self, handler, request, *args, **kwargs):
+        if request.method != 'GET':
+            return handler(request, *args, **kwargs)
+        cache = get_cache()
+        key = self.get_response_cache_key(request)
+        data = cache.get(key)
+        if data is not None:
+            return Response(data)
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(key, response.data, self.cache_timeout)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.get_cached_response(super(ResponseCacheMixin, self).list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.get_cached_response(super(ResponseCacheMixin, self).retrieve, request, *args, **kwargs)
+
+
+class ConditionalGetMixin:
+    """
+    ETag / Last-Modified validators for read-only actions, computed from version stamps before the action
+    runs: `If-None-Match` / `If-Modified-Since` matching them is answered with 304 without querying and
+    serializing the data.
+
+    By default the stamps are the versions of `cache_models`; views whose data is per user override
+    `get_version_stamps`.
+    """
+    cache_models = []
+
+    def get_version_stamps(self, request):
+        """Returns (stamps for the ETag, last modification time in ns or None)."""
+        versions = sorted(get_versions(self.cache_models).items())
+        return versions, max((version for model, version in versions), default=None)
+
+    def get_conditional_response(self, handler, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return handler(request, *args, **kwargs)
+        stamps, last_modified = self.get_version_stamps(request)
+        raw = json.dumps(request_signature(request) + [stamps], default=str)
+        etag = quote_etag(hashlib.md5(raw.encode()).hexdigest())
+        last_modified = last_modified // 10 ** 9 if last_modified else None
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+        response['ETag'] = etag
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.get_conditional_response(super(ConditionalGetMixin, self).list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.get_conditional_response(super(ConditionalGetMixin, self).retrieve, request, *args, **kwargs)
+
+
+class ValuesListMixin:
+    """
+    Opt-in fast path for read-only list actions: rows are fetched with .values() and rendered by
+    `values_serializer_class` (see values_serializers.py) into the same JSON as the regular serializer.
+    Keyset pages (?cursor=) need model instances for their cursors and go through the regular path.
+    """
+    values_serializer_class = None
+
+    def list(self, request, *args, **kwargs):
+        if self.values_serializer_class is None or KeysetPagination.cursor_query_param in request.query_params:
+            return super(ValuesListMixin, self).list(request, *args, **kwargs)
+        values_serializer = self.values_serializer_class(context=self.get_serializer_context())
+        queryset = values_serializer.get_queryset(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(values_serializer.to_representation(page))
+        return Response(values_serializer.to_representation(queryset))
+
+
+class FacetsMixin:
+    """
+    Adds `facets` (property value counts of the whole filtered result set, see ProductQuerySet.facets)
+    to the paginated list response.
+    """
+
+    def list(self, request, *args, **kwargs):
+        response = super(FacetsMixin, self).list(request, *args, **kwargs)
+        if response.status_code == 200 and isinstance(response.data, dict):
+            response.data['facets'] = self.filter_queryset(self.get_queryset()).facets()
+        return response
@@ -1,10 +1,11 @@
 import os
 from decimal import Decimal
-import datetime
 
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db import models
-from django.db.models import Q
+from django.db import connections, models, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import Concat, Substr
 from django.utils import timezone
 from django.contrib.auth import get_user_model
 
@@ -54,6 +55,16 @@ class StoreContact(models.Model):
         verbose_name_plural = "Контакты магазинов"
 
 
+class CategoryQuerySet(models.QuerySet):
+    def with_nested(self):
+        return self.annotate(has_nested=models.Exists(Category.objects.filter(category=models.OuterRef('pk'))))
+
+    def move_subtree(self, old_path, new_path):
+        return self.filter(path__startswith=old_path).update(
+            path=Concat(models.Value(new_path), Substr('path', len(old_path) + 1))
+        )
+
+
 class Category(models.Model):
     def upload_category_img(self, filename):
         return os.path.join("categories", str(self.id), filename)
@@ -64,11 +75,36 @@ class Category(models.Model):
     img = models.ImageField(upload_to=upload_category_img, null=True, default=None)
     moderator_confirmed = models.BooleanField(default=False)
     description = models.TextField(blank=True)
+    # материализованный путь от корня дерева: "<id корня>/.../<id>/", поддерживается Category.refresh_path
+    path = models.CharField(max_length=255, blank=True, default='', editable=False, db_index=True)
+
+    objects = CategoryQuerySet.as_manager()
 
     @property
     def nested(self):
+        if hasattr(self, 'has_nested'):
+            return self.has_nested
         return self.nested_categories.exists()
 
+    def clean(self):
+        if self.pk and self.category_id and f'/{self.pk}/' in f'/{self.category.path}{self.category_id}/':
+            raise ValidationError({'category': 'Категорию нельзя вложить в нее саму или в ее подкатегорию'})
+
+    def refresh_path(self):
+        parent_path = ''
+        if self.category_id:
+            parent_path = Category.objects.filter(id=self.category_id).values_list('path', flat=True).first() or ''
+            if f'/{self.id}/' in f'/{parent_path}':
+                return
+        path = f'{parent_path}{self.id}/'
+        old_path = Category.objects.filter(id=self.id).values_list('path', flat=True).first()
+        if old_path != path:
+            if old_path:
+                Category.objects.move_subtree(old_path, path)
+            else:
+                Category.objects.filter(id=self.id).update(path=path)
+        self.path = path
+
     def __str__(self):
         return self.name
 
@@ -77,27 +113,87 @@ class Category(models.Model):
         verbose_name_plural = "Категории товаров"
 
 
+class ProductQuerySet(models.QuerySet):
+    visibility_condition = Q(
+        category__moderator_confirmed=True, store__moderator_confirmed=True, store__blocked=False, blocked=False
+    )
+
+    def visible(self):
+        return self.filter(is_visible=True)
+
+    def refresh_visibility(self):
+        """Recomputes is_visible for the queryset with two set-based UPDATEs touching only changed rows."""
+        shown = self.filter(self.visibility_condition, is_visible=False).update(is_visible=True)
+        hidden = self.exclude(self.visibility_condition).filter(is_visible=True).update(is_visible=False)
+        return shown + hidden
+
+    def reserve(self, counts):
+        """
+        Takes {product id: count} units from stock within the caller's transaction. The rows are locked in id
+        order, so concurrent checkouts of overlapping carts queue up instead of deadlocking, and decremented by
+        one conditional UPDATE. Returns the ids of the products short of stock, nothing is taken then.
+        """
+        if not counts:
+            return []
+        needed = Case(*[When(id=product_id, then=Value(count)) for product_id, count in counts.items()],
+                      output_field=models.PositiveIntegerField())
+        with transaction.atomic():
+            stock = dict(self.select_for_update().filter(id__in=counts).order_by('id').values_list('id', 'count'))
+            short = sorted(product_id for product_id, count in counts.items() if stock.get(product_id, 0) < count)
+            if not short:
+                updated = self.filter(id__in=counts, count__gte=needed).update(count=F('count') - needed)
+                if updated != len(counts):
+                    # без блокировок строк (SQLite) остаток мог измениться между чтением и обновлением
+                    transaction.set_rollback(True)
+                    short = sorted(counts)
+        return short
+
+    def release(self, counts):
+        """Returns {product id: count} units to stock (canceled orders)."""
+        if counts:
+            self.filter(id__in=counts).update(count=F('count') + Case(
+                *[When(id=product_id, then=Value(count)) for product_id, count in counts.items()],
+                output_field=models.PositiveIntegerField()
+            ))
+
+    def facets(self):
+        """
+        Value counts of product properties over the queryset: {property name: [{"value", "count"}, ...]},
+        one GROUP BY query served by the (property_name, property_value, product) index.
+        """
+        rows = ProductProperty.objects.filter(product__in=self.order_by().values('pk')).values(
+            'property_name', 'property_value').annotate(count=models.Count('product')).order_by(
+            'property_name', '-count', 'property_value')
+        facets = dict()
+        for row in rows:
+            facets.setdefault(row['property_name'], []).append({'value': row['property_value'], 'count': row['count']})
+        return facets
+
+
 class Product(models.Model):
     name = models.CharField(max_length=1000)
     store = models.ForeignKey("marketplace.Store", on_delete=models.CASCADE)
     category = models.ForeignKey("marketplace.Category", on_delete=models.SET_NULL, null=True)
     cost = models.DecimalField(max_digits=12, decimal_places=2)
+    # cost with the active discount applied, maintained by pricing.refresh_effective_costs
+    effective_cost = models.DecimalField(max_digits=12, decimal_places=2, null=True, default=None, db_index=True)
     code = models.CharField(max_length=150, default=None)
     group = models.ForeignKey('marketplace.ProductGroup', default=None, null=True, on_delete=models.SET_NULL)
     count = models.PositiveIntegerField()
     blocked = models.BooleanField(default=False)
+    # товар подтвержден в подтвержденной категории незаблокированного подтвержденного магазина,
+    # поддерживается ProductQuerySet.refresh_visibility
+    is_visible = models.BooleanField(default=False, db_index=True)
     description = models.TextField(blank=True)
     keywords = models.TextField(blank=True)
 
+    objects = ProductQuerySet.as_manager()
+
     def dynamic_cost(self):
-        current_datetime = datetime.datetime.now()
-        if self.discounts.all().exists():
-            discount = self.discounts.filter(
-                Q(date_start__lt=current_datetime) |
-                Q(date_end__gt=current_datetime)).first()
-            return self.cost - (self.cost / 100) * discount.discount_value
-        else:
+        discount = self.discounts.active().order_by('id').first()
+        if discount is None:
             return None
+        return discount.apply(self.cost)
 
     # @property
     # def last_supply_date(self):
@@ -160,6 +256,7 @@ class ProductProperty(models.Model):
         verbose_name = 'Характеристика товара'
         verbose_name_plural = 'Характеристики товаров'
         unique_together = ['product', 'property_name']
+        indexes = [models.Index(fields=['property_name', 'property_value', 'product'])]
 
 
 # class Supply(models.Model):
@@ -187,11 +284,57 @@ class ProductProperty(models.Model):
 #         verbose_name_plural = 'Позиции привозов товаров'
 
 
+class CartPositionQuerySet(models.QuerySet):
+    def apply_counts(self, counts, **owner):
+        """
+        Sets product counts ({product id: count}, 0 removes the product) in the cart selected by the queryset
+        with one DELETE, one bulk UPDATE and one bulk INSERT whatever the number of changes. Created positions
+        get the `owner` fields (user or tmp_user_code).
+        """
+        changed = {product_id: count for product_id, count in counts.items() if count > 0}
+        kept = dict()
+        duplicates = list()
+        for position in self.select_for_update().filter(product_id__in=changed).order_by('id'):
+            # дубликаты одного товара схлопываются в первую позицию
+            if position.product_id in kept:
+                duplicates.append(position.id)
+                continue
+            position.count = changed[position.product_id]
+            position.updated_time = timezone.now()
+            kept[position.product_id] = position
+
+        removed = [product_id for product_id in counts if product_id not in changed]
+        if removed or duplicates:
+            self.filter(Q(product_id__in=removed) | Q(id__in=duplicates)).delete()
+        self.model.objects.bulk_update(kept.values(), ['count', 'updated_time'])
+        self.model.objects.bulk_create([
+            self.model(product_id=product_id, count=count, **owner)
+            for product_id, count in changed.items() if product_id not in kept
+        ])
+
+    def merge_counts(self, counts, **owner):
+        """
+        Adds product counts to the cart selected by the queryset: counts of a product (including its duplicate
+        positions) are summed and capped at the product stock, out of stock products are removed.
+        """
+        totals = dict(counts)
+        for product_id, count in self.select_for_update().values_list('product_id', 'count'):
+            totals[product_id] = totals.get(product_id, 0) + count
+        stock = dict(Product.objects.filter(id__in=totals).values_list('id', 'count'))
+        self.apply_counts(
+            {product_id: min(total, stock.get(product_id, 0)) for product_id, total in totals.items()}, **owner
+        )
+
+
 class CartPosition(models.Model):
     user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, null=True, default=None)
-    tmp_user_code = models.TextField(blank=True)
+    tmp_user_code = models.TextField(blank=True, db_index=True)
     product = models.ForeignKey("marketplace.Product", on_delete=models.CASCADE)
     count = models.PositiveIntegerField(default=1)
+    # время последнего изменения, по нему удаляются брошенные анонимные корзины (purge_anonymous_carts)
+    updated_time = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = CartPositionQuerySet.as_manager()
 
     def __str__(self):
         # {self.user.name}:
@@ -229,29 +372,107 @@ class OrderAddress(models.Model):
         verbose_name_plural = 'Адреса ппользователей'
 
 
+class InsertQuerySet(models.QuerySet):
+    def create_all(self, objects):
+        """
+        bulk_create that always sets primary keys: one INSERT ... RETURNING where the database supports it
+        (PostgreSQL), an INSERT per object elsewhere.
+        """
+        if connections[self.db].features.can_return_rows_from_bulk_insert:
+            return self.bulk_create(objects)
+        for obj in objects:
+            obj.save(force_insert=True, using=self.db)
+        return objects
+
+
+class OrderQuerySet(InsertQuerySet):
+    def create_all(self, objects):
+        for order in objects:
+            order.state = order.get_state()
+        return super(OrderQuerySet, self).create_all(objects)
+
+    def state_expression(self, values=None):
+        """
+        Order.get_state as an SQL expression. Flags set to constants in `values` are substituted, since
+        an UPDATE computes all of its expressions from the old values of the row.
+        """
+        values = values or dict()
+        whens = list()
+        default = self.model.DELIVERED
+        for flag, value, state in self.model.STATE_RULES:
+            if flag not in values:
+                whens.append(When(**{flag: value}, then=Value(state)))
+            elif bool(values[flag]) == value:
+                default = state
+                break
+        return Case(*whens, default=Value(default), output_field=models.CharField()) if whens else Value(default)
+
+    def update(self, **kwargs):
+        # состояние пересчитывается тем же UPDATE, что меняет флаги
+        if 'state' not in kwargs and any(rule[0] in kwargs for rule in self.model.STATE_RULES):
+            kwargs['state'] = self.state_expression(kwargs)
+        return super(OrderQuerySet, self).update(**kwargs)
+
+    def refresh_state(self):
+        """Recomputes state for the queryset with one UPDATE touching only stale rows."""
+        state = self.state_expression()
+        return self.exclude(state=state).update(state=state)
+
+
 class Order(models.Model):
+    CANCELED = 'canceled'
+    AWAITING_PAYMENT = 'awaiting_payment'
+    ASSEMBLING = 'assembling'
+    DELIVERING = 'delivering'
+    DELIVERED = 'delivered'
+    # в порядке жизненного цикла заказа, по нему сортирует админка
+    STATES = [
+        (AWAITING_PAYMENT, 'Ожидает оплаты'),
+        (ASSEMBLING, 'Собирается мгазином'),
+        (DELIVERING, 'Доставляется'),
+        (DELIVERED, 'Доставлен'),
+        (CANCELED, 'Заказ отменен'),
+    ]
+    # (флаг, значение, состояние): первое совпавшее правило задает состояние, иначе DELIVERED
+    STATE_RULES = [
+        ('canceled', True, CANCELED),
+        ('paid', False, AWAITING_PAYMENT),
+        ('completed', False, ASSEMBLING),
+        ('delivered', False, DELIVERING),
+    ]
+
     payment_id = models.CharField(max_length=100, default=None, null=True)
     store = models.ForeignKey('marketplace.Store', on_delete=models.SET_NULL, null=True)
     user = models.ForeignKey(get_user_model(), on_delete=models.SET_NULL, null=True)
     address = models.ForeignKey("marketplace.OrderAddress", on_delete=models.SET_NULL, null=True)
     amount = models.DecimalField(max_digits=12, decimal_places=2)
     created_time = models.DateTimeField(auto_now_add=True)
+    updated_time = models.DateTimeField(auto_now=True)
     paid = models.BooleanField(default=False)
     canceled = models.BooleanField(default=False)
     completed = models.BooleanField(default=False)
     delivered = models.BooleanField(default=False)
+    # производное от флагов состояние, по нему фильтруются и сортируются списки заказов
+    state = models.CharField(max_length=20, choices=STATES, default=AWAITING_PAYMENT, db_index=True)
+
+    objects = OrderQuerySet.as_manager()
+
+    def get_state(self):
+        for flag, value, state in self.STATE_RULES:
+            if getattr(self, flag) == value:
+                return state
+        return self.DELIVERED
 
     @property
     def status(self):
-        if self.canceled:
-            return 'Заказ отменен'
-        if not self.paid:
-            return 'Ожидает оплаты'
-        if not self.completed:
-            return 'Собирается мгазином'
-        if not self.delivered:
-            return 'Доставляется'
-        return 'Доставлен'
+        return dict(self.STATES)[self.get_state()]
+
+    def save(self, *args, **kwargs):
+        self.state = self.get_state()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'state' not in update_fields:
+            kwargs['update_fields'] = list(update_fields) + ['state']
+        super(Order, self).save(*args, **kwargs)
 
     def __str__(self):
         return f'{self.user.name}: {self.amount} RUB ({self.status})'
@@ -259,12 +480,19 @@ class Order(models.Model):
     class Meta:
         verbose_name = 'Заказ'
         verbose_name_plural = 'Заказы'
+        indexes = [
+            models.Index(fields=['store', 'state', 'created_time']),
+            models.Index(fields=['user', 'created_time']),
+            models.Index(fields=['payment_id']),
+        ]
 
 
 class OrderPosition(models.Model):
     order = models.ForeignKey('marketplace.Order', on_delete=models.CASCADE)
     product = models.ForeignKey('marketplace.Product', on_delete=models.SET_NULL, null=True)
     count = models.PositiveIntegerField(default=1)
+    # цена товара на момент заказа, у старых позиций не заполнена
+    cost = models.DecimalField(max_digits=10, decimal_places=2, default=None, null=True)
 
     def __str__(self):
         return f'{self.product.name} {self.count} шт.'
@@ -274,6 +502,158 @@ class OrderPosition(models.Model):
         verbose_name_plural = 'Позиции заказов'
 
 
+class StoreSalesDay(models.Model):
+    """
+    Daily sales rollup of a store over the orders created that day. A change of an order marks its day stale
+    (StaleSalesDay), the process_sales_rollups worker rebuilds the day from the orders (analytics.py).
+    Paid orders that are not canceled are counted as sales.
+    """
+    store = models.ForeignKey('marketplace.Store', on_delete=models.CASCADE)
+    date = models.DateField()
+    orders = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    units = models.PositiveIntegerField(default=0)
+    canceled_orders = models.PositiveIntegerField(default=0)
+    delivered_orders = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.store_id} {self.date}: {self.revenue} RUB'
+
+    class Meta:
+        verbose_name = 'Продажи магазина за день'
+        verbose_name_plural = 'Продажи магазинов по дням'
+        unique_together = [('store', 'date')]
+
+
+class ProductSalesDay(models.Model):
+    """Daily sales rollup of a product, maintained together with StoreSalesDay."""
+    store = models.ForeignKey('marketplace.Store', on_delete=models.CASCADE)
+    product = models.ForeignKey('marketplace.Product', on_delete=models.CASCADE)
+    date = models.DateField()
+    orders = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    units = models.PositiveIntegerField(default=0)
+    canceled_units = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.product_id} {self.date}: {self.revenue} RUB'
+
+    class Meta:
+        verbose_name = 'Продажи товара за день'
+        verbose_name_plural = 'Продажи товаров по дням'
+        unique_together = [('product', 'date')]
+        indexes = [models.Index(fields=['store', 'date'])]
+
+
+class StaleSalesDay(models.Model):
+    """Store day whose rollups must be rebuilt, one row per day however many orders of it changed."""
+    store = models.ForeignKey('marketplace.Store', on_delete=models.CASCADE)
+    date = models.DateField()
+    marked_time = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.store_id} {self.date}'
+
+    class Meta:
+        verbose_name = 'Устаревшая статистика продаж'
+        verbose_name_plural = 'Устаревшая статистика продаж'
+        unique_together = [('store', 'date')]
+
+
+class PaymentOutbox(models.Model):
+    """
+    Payment to create for an order. Rows are written in the checkout transaction and processed by the
+    process_payment_outbox worker (payments.py), so the provider is never called while the transaction
+    holds locks.
+    """
+    PENDING = 'pending'
+    CREATED = 'created'
+    FAILED = 'failed'
+    STATUSES = [(PENDING, 'Ожидает создания'), (CREATED, 'Создан'), (FAILED, 'Ошибка')]
+    MAX_ATTEMPTS = 10
+
+    order = models.ForeignKey('marketplace.Order', on_delete=models.CASCADE, related_name='payment_outbox')
+    idempotency_key = models.UUIDField(unique=True)
+    status = models.CharField(max_length=20, choices=STATUSES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_time = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    payment_id = models.CharField(max_length=100, default=None, null=True)
+    confirmation_url = models.TextField(blank=True)
+    created_time = models.DateTimeField(auto_now_add=True)
+
+    objects = InsertQuerySet.as_manager()
+
+    def __str__(self):
+        return f'Платеж заказа #{self.order_id} ({self.status})'
+
+    class Meta:
+        verbose_name = 'Создание платежа'
+        verbose_name_plural = 'Очередь создания платежей'
+        indexes = [models.Index(fields=['status', 'next_attempt_time'])]
+
+
+class PaymentNotification(models.Model):
+    """
+    Payment service notification, stored once per event and payment. The webhook only inserts the row,
+    the process_payment_notifications worker (payments.py) applies it and notifies the users.
+    """
+    event = models.CharField(max_length=50)
+    payment_id = models.CharField(max_length=100)
+    payload = models.JSONField()
+    received_time = models.DateTimeField(auto_now_add=True)
+    processed_time = models.DateTimeField(default=None, null=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_time = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f'{self.event} {self.payment_id}'
+
+    class Meta:
+        verbose_name = 'Уведомление об оплате'
+        verbose_name_plural = 'Уведомления об оплате'
+        unique_together = ['event', 'payment_id']
+        indexes = [models.Index(fields=['processed_time', 'next_attempt_time'])]
+
+
+class PushNotification(models.Model):
+    """
+    Push notification to a topic of FCM subscribers, sent by the process_push_queue worker
+    (notifications.py). Notifications failing MAX_ATTEMPTS times stay in the table as dead letters.
+    """
+    PENDING = 'pending'
+    SENT = 'sent'
+    DEAD = 'dead'
+    STATUSES = [(PENDING, 'Ожидает отправки'), (SENT, 'Отправлено'), (DEAD, 'Не доставлено')]
+    MAX_ATTEMPTS = 8
+
+    topic = models.CharField(max_length=100)
+    title = models.CharField(max_length=200)
+    body = models.TextField()
+    data = models.JSONField(default=dict)
+    status = models.CharField(max_length=20, choices=STATUSES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_time = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_time = models.DateTimeField(auto_now_add=True)
+    sent_time = models.DateTimeField(default=None, null=True)
+
+    def __str__(self):
+        return f'{self.topic}: {self.title} ({self.status})'
+
+    class Meta:
+        verbose_name = 'Push-уведомление'
+        verbose_name_plural = 'Очередь push-уведомлений'
+        indexes = [models.Index(fields=['status', 'next_attempt_time'])]
+
+
+class DiscountQuerySet(models.QuerySet):
+    def active(self, moment=None):
+        moment = moment or timezone.now()
+        return self.filter(date_start__lte=moment, date_end__gt=moment)
+
+
 class Discount(models.Model):
     user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, related_name="discounts", default=None)
     product = models.ForeignKey("marketplace.Product", on_delete=models.CASCADE, related_name="discounts")
@@ -285,6 +665,11 @@ class Discount(models.Model):
     date_start = models.DateTimeField()
     date_end = models.DateTimeField()
 
+    objects = DiscountQuerySet.as_manager()
+
+    def apply(self, cost):
+        return cost - (cost / 100) * self.discount_value
+
     def __str__(self):
         return f'Скидка на {self.product.name}'
 
@@ -362,6 +747,10 @@ class DeliveryCost(models.Model):
         validators=[MinValueValidator(Decimal(0.0))]
     )
 
+    def apply(self, amount):
+        """Delivery cost of an order of `amount`: the reduced discount_cost once the amount reaches cost_indication."""
+        return self.discount_cost if amount >= self.cost_indication else self.cost
+
     def __str__(self):
         return f'Цена доставки в {self.city.name}'
 
@@ -0,0 +1,173 @@
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.utils import json, encoders
+
+from .models import PushNotification
+
+from .queues import claim
+from .queues import retry_time
+
+from .serializers import OrderSerializer
+
+
+class PushSender(ABC):
+    @abstractmethod
+    def send(self, notification):
+        """Delivers one push notification (PushNotification), raises on failure."""
+
+
+class FCMPushSender(PushSender):
+    def __init__(self):
+        from pyfcm import FCMNotification
+        self.push_service = FCMNotification(api_key=settings.FCM_DJANGO_SETTINGS["FCM_SERVER_KEY"])
+
+    def send(self, notification):
+        result = self.push_service.notify_topic_subscribers(
+            message_title=notification.title,
+            badge=1,
+            topic_name=notification.topic,
+            message_body=notification.body,
+            sound="default",
+            extra_notification_kwargs=notification.data
+        )
+        if isinstance(result, dict) and (result.get('failure') or result.get('error')):
+            raise RuntimeError(f'FCM: {result}')
+
+
+class FakePushSender(PushSender):
+    """Local sender for tests and development: keeps sent notifications in `sent`, `fail` decides failures."""
+    sent = list()
+    fail = None
+
+    def send(self, notification):
+        fail = type(self).fail
+        if fail is not None and fail(notification):
+            raise RuntimeError('fake FCM failure')
+        self.sent.append({'topic': notification.topic, 'title': notification.title, 'data': notification.data})
+
+
+PUSH_SENDERS = {
+    'fcm': FCMPushSender,
+    'fake': FakePushSender,
+}
+
+
+def get_push_sender():
+    """Sender named by settings.MARKETPLACE_PUSH_SENDER ("fcm" if not set)."""
+    return PUSH_SENDERS[getattr(settings, 'MARKETPLACE_PUSH_SENDER', 'fcm')]()
+
+
+def enqueue_push(topic, title, body, data=None):
+    return PushNotification.objects.create(topic=topic, title=title, body=body, data=data or dict())
+
+
+def claim_pushes(limit, lease=60):
+    """Takes up to `limit` due pending notifications for sending (see queues.claim)."""
+    return claim(PushNotification.objects.filter(status=PushNotification.PENDING), limit,
+                 ['next_attempt_time', 'id'], lease)
+
+
+def send_push(sender, notification):
+    started = time.monotonic()
+    try:
+        sender.send(notification)
+        error = None
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    return notification, error, time.monotonic() - started
+
+
+def process_push_queue(limit=100, workers=8):
+    """
+    Sends a batch of due notifications from a pool of `workers` threads and stores the results with one
+    bulk UPDATE. Failed notifications are retried with exponential backoff, after MAX_ATTEMPTS they are
+    left as dead letters. Returns the batch metrics.
+    """
+    notifications = claim_pushes(limit)
+    metrics = {'sent': 0, 'retried': 0, 'dead': 0, 'seconds': 0, 'send_latency': list(), 'queue_latency': list()}
+    if not notifications:
+        return metrics
+    started = time.monotonic()
+    sender = get_push_sender()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda notification: send_push(sender, notification), notifications))
+
+    now = timezone.now()
+    for notification, error, duration in results:
+        notification.attempts += 1
+        metrics['send_latency'].append(duration)
+        if error is None:
+            notification.status = PushNotification.SENT
+            notification.sent_time = now
+            notification.last_error = ''
+            metrics['sent'] += 1
+            metrics['queue_latency'].append((now - notification.created_time).total_seconds())
+            continue
+        notification.last_error = error
+        if notification.attempts >= PushNotification.MAX_ATTEMPTS:
+            notification.status = PushNotification.DEAD
+            metrics['dead'] += 1
+        else:
+            notification.next_attempt_time = retry_time(notification.attempts, 3600)
+            metrics['retried'] += 1
+    PushNotification.objects.bulk_update(
+        [notification for notification, error, duration in results],
+        ['status', 'attempts', 'last_error', 'next_attempt_time', 'sent_time']
+    )
+    metrics['seconds'] = time.monotonic() - started
+    return metrics
+
+
+def send_new_orders(orders):
+    """Notifies the order-admin groups of the stores about new orders, all messages are sent concurrently."""
+    channel_layer = get_channel_layer()
+    messages = [
+        (f"order-admin-{order.store.user_id}", json.dumps(data, cls=encoders.JSONEncoder, ensure_ascii=False))
+        for order, data in zip(orders, OrderSerializer(orders, many=True).data)
+    ]
+
+    async def send_all():
+        await asyncio.gather(*[
+            channel_layer.group_send(group, {"type": "new_order", "message": message}) for group, message in messages
+        ])
+
+    async_to_sync(send_all)()
+
+
+def send_order_paid(order):
+    """
+    Order channel groups and the push notification to the buyer about a paid order. The push is queued in the
+    caller's transaction, the channel messages are sent once it commits.
+    """
+    channel_layer = get_channel_layer()
+    instance_data = OrderSerializer(order).data
+    instance_text_data = json.dumps(instance_data, cls=encoders.JSONEncoder, ensure_ascii=False)
+
+    def send_messages():
+        async_to_sync(channel_layer.group_send)(
+            f"order-{order.id}", {"type": "order_change", "message": instance_text_data}
+        )
+        async_to_sync(channel_layer.group_send)(
+            f"order-admin-{order.id}", {"type": "order_paid", "message": instance_text_data}
+        )
+
+    transaction.on_commit(send_messages)
+    extra_notification_kwargs = {
+        "push_type": "order_change",
+        "order_id": order.id,
+        "order": json.loads(instance_text_data)
+    }
+    enqueue_push(
+        topic=str(order.user_id),
+        title=f"Заказ #{order.id} оплачен",
+        body="Заказ успешно оплачен! Продавец уже начал его собирать.",
+        data=extra_notification_kwargs
+    )
@@ -1,7 +1,160 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import binascii
+import json
+from collections import OrderedDict
+
+from django.db.models import F, Q
+from django.core.exceptions import FieldDoesNotExist, ValidationError as DjangoValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 
 class StandardPagination(PageNumberPagination):
     page_size = 30
     page_size_query_param = 'page_size'
     max_page_size = 100
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (cursor) pagination without COUNT(*) and OFFSET.
+
+    Rows are ordered by the ?ordering= terms allowed by the view's ordering_fields (or view.ordering) with
+    the primary key as a tie-breaker. The cursor holds the ordering values of the last row of the page, and
+    the next page is selected with a WHERE condition on them, so every page costs the same whatever its depth.
+    A queryset still ordered by an annotation (search relevance without ?ordering=) is rejected, the keyset
+    cannot hold it.
+    """
+    page_size = 30
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Неверный курсор'
+    annotation_ordering_message = 'Курсорная навигация недоступна при сортировке по релевантности, укажите ordering'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if any(isinstance(term, str) and term.lstrip('-') in queryset.query.annotations
+               for term in queryset.query.order_by):
+            raise ValidationError({self.cursor_query_param: self.annotation_ordering_message})
+        self.keys = self.get_keys(request, queryset, view)
+        queryset = queryset.order_by(*[
+            F(name).desc(nulls_last=True) if descending else F(name).asc(nulls_first=True)
+            for name, descending, field in self.keys
+        ])
+
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded:
+            queryset = queryset.filter(self.get_position_filter(self.decode_cursor(encoded)))
+
+        rows = list(queryset[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+            if page_size > 0:
+                return min(page_size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return self.page_size
+
+    def get_keys(self, request, queryset, view):
+        ordering = OrderingFilter().get_ordering(request, queryset, view) if view is not None else None
+        terms = [term for term in (ordering or []) if term.lstrip('-') not in ('pk', 'id')]
+        descending = terms[-1].startswith('-') if terms else (ordering or ['id'])[0].startswith('-')
+        terms.append('-id' if descending else 'id')
+        return [(term.lstrip('-'), term.startswith('-'), self.get_field(queryset.model, term.lstrip('-')))
+                for term in terms]
+
+    @staticmethod
+    def get_field(model, name):
+        field = None
+        for part in name.split('__'):
+            try:
+                field = model._meta.get_field(part)
+            except FieldDoesNotExist:
+                raise ValidationError({'ordering': f'Сортировка по полю {name} недоступна при курсорной навигации'})
+            model = field.related_model
+        return field
+
+    def get_position_filter(self, values):
+        position = Q(pk__in=[])
+        equal = Q()
+        for (name, descending, field), value in zip(self.keys, values):
+            if value is None:
+                after = Q(pk__in=[]) if descending else Q(**{f'{name}__isnull': False})
+                same = Q(**{f'{name}__isnull': True})
+            elif descending:
+                after = Q(**{f'{name}__lt': value}) | Q(**{f'{name}__isnull': True})
+                same = Q(**{name: value})
+            else:
+                after = Q(**{f'{name}__gt': value})
+                same = Q(**{name: value})
+            position |= equal & after
+            equal &= same
+        return position
+
+    def get_row_values(self, row):
+        values = list()
+        for name, descending, field in self.keys:
+            value = row
+            for part in name.split('__')[:-1]:
+                value = getattr(value, part) if value is not None else None
+            values.append(getattr(value, field.attname) if value is not None else None)
+        return values
+
+    def encode_cursor(self, values):
+        data = json.dumps(values, cls=DjangoJSONEncoder)
+        return base64.urlsafe_b64encode(data.encode()).decode()
+
+    def decode_cursor(self, encoded):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+            if not isinstance(values, list) or len(values) != len(self.keys):
+                raise ValueError
+            return [
+                None if value is None else field.to_python(value)
+                for (name, descending, field), value in zip(self.keys, values)
+            ]
+        except (ValueError, TypeError, binascii.Error, UnicodeDecodeError, DjangoValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.get_row_values(self.page[-1])))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+
+class KeysetOptionalPagination(StandardPagination):
+    """
+    Page-number pagination by default; a client opts into keyset pagination by passing ?cursor=
+    (empty for the first page) and then follows the `next` links.
+    """
+    keyset_pagination_class = KeysetPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if self.keyset_pagination_class.cursor_query_param in request.query_params:
+            self.keyset = self.keyset_pagination_class()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super(KeysetOptionalPagination, self).paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super(KeysetOptionalPagination, self).get_paginated_response(data)
@@ -0,0 +1,267 @@
+import json
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Order
+from .models import PaymentOutbox
+from .models import PaymentNotification
+
+from .queues import claim
+from .queues import retry_time
+
+from .analytics import mark_sales_stale
+
+from .notifications import send_order_paid
+
+
+class PaymentProvider(ABC):
+    """
+    Payment service used by the outbox worker. Payments are created with an idempotency key, so a retried
+    request for the same outbox row never charges twice.
+    """
+
+    @abstractmethod
+    def create(self, params, idempotency_key):
+        """Returns {"id", "status", "confirmation_url"} of the created payment."""
+
+    @abstractmethod
+    def find(self, payment_id):
+        """Returns the payment object as the provider's JSON."""
+
+
+class YooKassaPaymentProvider(PaymentProvider):
+    def __init__(self):
+        from yookassa import Configuration
+        Configuration.account_id = settings.YOOKASSA_MARKETPLACE["account_id"]
+        Configuration.secret_key = settings.YOOKASSA_MARKETPLACE["secret_key"]
+
+    def create(self, params, idempotency_key):
+        from yookassa import Payment
+        payment = Payment.create(params, idempotency_key)
+        return {
+            'id': payment.id,
+            'status': payment.status,
+            'confirmation_url': payment.confirmation.confirmation_url if payment.confirmation else None,
+        }
+
+    def find(self, payment_id):
+        from yookassa import Payment
+        return json.loads(Payment.find_one(payment_id).json())
+
+
+class FakePaymentProvider(PaymentProvider):
+    """Local provider for tests and development: payments live in memory, keyed by the idempotency key."""
+    payments = dict()
+
+    def create(self, params, idempotency_key):
+        key = str(idempotency_key)
+        if key not in self.payments:
+            payment_id = f'fake-{key}'
+            self.payments[key] = {
+                'id': payment_id,
+                'status': 'pending',
+                'amount': params['amount'],
+                'description': params.get('description', ''),
+                'confirmation': {
+                    'type': 'redirect', 'confirmation_url': f'https://payments.invalid/confirm/{payment_id}'
+                },
+            }
+        payment = self.payments[key]
+        return {'id': payment['id'], 'status': payment['status'],
+                'confirmation_url': payment['confirmation']['confirmation_url']}
+
+    def find(self, payment_id):
+        return next(payment for payment in self.payments.values() if payment['id'] == payment_id)
+
+
+PAYMENT_PROVIDERS = {
+    'yookassa': YooKassaPaymentProvider,
+    'fake': FakePaymentProvider,
+}
+
+
+def get_payment_provider():
+    """Provider named by settings.MARKETPLACE_PAYMENT_PROVIDER ("yookassa" if not set)."""
+    return PAYMENT_PROVIDERS[getattr(settings, 'MARKETPLACE_PAYMENT_PROVIDER', 'yookassa')]()
+
+
+def payment_params(order):
+    return {
+        "amount": {
+            "value": str(order.amount),
+            "currency": 'RUB'
+        },
+        "confirmation": {
+            "type": "redirect",
+            "return_url": settings.YOOKASSA_MARKETPLACE["confirmation_redirect_url"]
+        },
+        "capture": True,
+        "description": f"Заказ USER:{order.user_id} {str(order.amount)}RUB"
+    }
+
+
+def process_payment(outbox, provider=None):
+    """
+    Creates the payment of an outbox row outside of any transaction and attaches it to the order.
+    Failed attempts are retried with exponential backoff up to PaymentOutbox.MAX_ATTEMPTS times.
+    """
+    provider = provider or get_payment_provider()
+    try:
+        payment = provider.create(payment_params(outbox.order), outbox.idempotency_key)
+    except Exception as e:
+        outbox.attempts += 1
+        outbox.last_error = f'{type(e).__name__}: {e}'
+        if outbox.attempts >= PaymentOutbox.MAX_ATTEMPTS:
+            outbox.status = PaymentOutbox.FAILED
+        else:
+            outbox.next_attempt_time = retry_time(outbox.attempts, 300)
+        outbox.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt_time'])
+        return False
+
+    with transaction.atomic():
+        outbox.status = PaymentOutbox.CREATED
+        outbox.payment_id = payment['id']
+        outbox.confirmation_url = payment['confirmation_url'] or ''
+        outbox.last_error = ''
+        outbox.save(update_fields=['status', 'payment_id', 'confirmation_url', 'last_error'])
+        Order.objects.filter(id=outbox.order_id).update(payment_id=payment['id'], updated_time=timezone.now())
+    return True
+
+
+def create_payments(outboxes, workers=8):
+    """
+    Creates the payments of just committed outbox rows in parallel threads, so N payments take about as long
+    as one. Rows that fail are left to process_payment_outbox. Returns the results of process_payment.
+    """
+    provider = get_payment_provider()
+
+    def create(outbox):
+        try:
+            return process_payment(outbox, provider)
+        finally:
+            # у каждого потока свое соединение с базой
+            connection.close()
+
+    if not outboxes:
+        return list()
+    # строки, которые уже взял process_payment_outbox, пропускаются
+    claimed = set(claim_payments(
+        PaymentOutbox.objects.filter(id__in=[outbox.id for outbox in outboxes]), len(outboxes)
+    ))
+    outboxes = [outbox for outbox in outboxes if outbox.id in claimed]
+    if not outboxes:
+        return list()
+    with ThreadPoolExecutor(max_workers=min(workers, len(outboxes))) as executor:
+        return list(executor.map(create, outboxes))
+
+
+def claim_payments(outboxes, limit, lease=60):
+    """
+    Takes up to `limit` due pending rows of the `outboxes` queryset (see queues.claim) and returns their ids,
+    so the provider is called once per attempt.
+    """
+    outboxes = claim(outboxes.filter(status=PaymentOutbox.PENDING), limit, ['next_attempt_time', 'id'], lease)
+    return [outbox.id for outbox in outboxes]
+
+
+def process_payment_outbox(limit=50):
+    """Processes claimed due pending outbox rows, returns (created, failed attempts)."""
+    provider = get_payment_provider()
+    created = failed = 0
+    claimed = PaymentOutbox.objects.filter(id__in=claim_payments(PaymentOutbox.objects.all(), limit))
+    for outbox in claimed.select_related('order').order_by('id'):
+        if process_payment(outbox, provider):
+            created += 1
+        else:
+            failed += 1
+    return created, failed
+
+
+def enqueue_payment(order):
+    """Pending or created outbox row of the order, a new one if the previous attempts failed."""
+    outbox = order.payment_outbox.exclude(status=PaymentOutbox.FAILED).order_by('-id').first()
+    if outbox is None:
+        outbox = PaymentOutbox.objects.create(order=order, idempotency_key=uuid.uuid4())
+    return outbox
+
+
+def enqueue_payments(orders):
+    """New outbox rows of freshly created orders, inserted at once."""
+    return PaymentOutbox.objects.create_all([
+        PaymentOutbox(order=order, idempotency_key=uuid.uuid4()) for order in orders
+    ])
+
+
+def payment_state(outbox):
+    if outbox is None:
+        return {'status': None, 'payment_id': None, 'confirmation_url': None}
+    return {
+        'status': outbox.status,
+        'payment_id': outbox.payment_id,
+        'confirmation_url': outbox.confirmation_url or None,
+    }
+
+
+def record_notification(data):
+    """
+    Stores a notification of the payment service with a single INSERT, a repeated delivery of the same
+    event is ignored. Returns False if the notification is malformed.
+    """
+    payment = data.get('object') if isinstance(data, dict) else None
+    if not isinstance(payment, dict) or not isinstance(payment.get('id'), str):
+        return False
+    event = data.get('event') or f"payment.{payment.get('status')}"
+    PaymentNotification.objects.bulk_create(
+        [PaymentNotification(event=event, payment_id=payment['id'], payload=data)], ignore_conflicts=True
+    )
+    return True
+
+
+def apply_notification(notification):
+    if not notification.event.startswith('payment.'):
+        return
+    # уведомление может обогнать сохранение платежа заказа (process_payment), тогда DoesNotExist
+    # отправляет его на повтор
+    order = Order.objects.get(payment_id=notification.payment_id)
+    status = notification.payload['object'].get('status')
+    if status == 'succeeded':
+        # повторное уведомление об уже оплаченном заказе ничего не отправляет; оплата и push-уведомление
+        # фиксируются вместе, иначе после ошибки отправки повтор уже не нашел бы неоплаченный заказ
+        with transaction.atomic():
+            if Order.objects.filter(id=order.id, paid=False).update(paid=True, updated_time=timezone.now()):
+                mark_sales_stale([order])
+                order.refresh_from_db()
+                send_order_paid(order)
+    elif status == 'canceled' and not order.paid and not order.canceled:
+        # платеж не прошел - заказу нужен новый
+        PaymentOutbox.objects.filter(payment_id=notification.payment_id).update(status=PaymentOutbox.FAILED)
+        enqueue_payment(order)
+
+
+def claim_notifications(limit, lease=60):
+    """Takes up to `limit` due unprocessed notifications in the order of arrival (see queues.claim)."""
+    return claim(PaymentNotification.objects.filter(processed_time__isnull=True), limit, ['id'], lease)
+
+
+def process_payment_notifications(limit=100):
+    """Applies claimed due notifications in the order of arrival, returns (processed, failed attempts)."""
+    processed = failed = 0
+    for notification in claim_notifications(limit):
+        try:
+            apply_notification(notification)
+        except Exception as e:
+            notification.attempts += 1
+            notification.last_error = f'{type(e).__name__}: {e}'
+            notification.next_attempt_time = retry_time(notification.attempts, 300)
+            notification.save(update_fields=['attempts', 'last_error', 'next_attempt_time'])
+            failed += 1
+            continue
+        notification.processed_time = timezone.now()
+        notification.save(update_fields=['processed_time'])
+        processed += 1
+    return processed, failed
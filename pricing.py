@@ -0,0 +1,81 @@
+from decimal import Decimal
+
+from django.db import models
+from django.db.models import F, OuterRef, Subquery, Value, ExpressionWrapper
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Discount
+
+
+class DiscountPricing:
+    """
+    Resolves discounted prices for a batch of products.
+
+    Active discounts for every product passed to `load` are fetched with a single query and kept in memory,
+    so serializing a page of products (or cart positions) does not query discounts per row.
+    """
+
+    def __init__(self, products=(), moment=None):
+        self.moment = moment or timezone.now()
+        self.discounts = dict()
+        self.loaded_ids = set()
+        self.load(products)
+
+    def load(self, products):
+        self.load_ids(product.id for product in products)
+
+    def load_ids(self, product_ids):
+        product_ids = set(product_ids) - self.loaded_ids
+        if not product_ids:
+            return
+        discounts = Discount.objects.active(self.moment).filter(product_id__in=product_ids).order_by('id')
+        for discount in discounts:
+            self.discounts.setdefault(discount.product_id, discount)
+        self.loaded_ids |= product_ids
+
+    def discount(self, product):
+        return self.discount_for(product.id)
+
+    def discount_for(self, product_id):
+        if product_id not in self.loaded_ids:
+            self.load_ids([product_id])
+        return self.discounts.get(product_id)
+
+    def cost_with_discount(self, product):
+        return self.cost_for(product.id, product.cost)
+
+    def cost_for(self, product_id, cost):
+        discount = self.discount_for(product_id)
+        if discount is None:
+            return None
+        return discount.apply(cost)
+
+    def effective_cost(self, product):
+        return self.effective_cost_for(product.id, product.cost)
+
+    def effective_cost_for(self, product_id, cost):
+        discounted = self.cost_for(product_id, cost)
+        return cost if discounted is None else discounted
+
+    def amount(self, positions):
+        positions = list(positions)
+        self.load(position.product for position in positions)
+        return sum((self.effective_cost(position.product) * position.count for position in positions), Decimal(0))
+
+
+def get_pricing(context):
+    return context.setdefault('pricing', DiscountPricing())
+
+
+def refresh_effective_costs(products, moment=None):
+    """
+    Recalculates Product.effective_cost for the given queryset with a single UPDATE statement.
+    """
+    moment = moment or timezone.now()
+    discount_value = Discount.objects.active(moment).filter(product=OuterRef('pk')).order_by('id')
+    discounted_cost = ExpressionWrapper(
+        F('cost') - F('cost') * Subquery(discount_value.values('discount_value')[:1]) / Value(100.0),
+        output_field=models.DecimalField(max_digits=12, decimal_places=2)
+    )
+    return products.update(effective_cost=Coalesce(discounted_cost, F('cost')))
@@ -0,0 +1,25 @@
+import datetime
+
+from django.db import transaction
+from django.utils import timezone
+
+
+def claim(queryset, limit, ordering, lease=60):
+    """
+    Takes up to `limit` due rows (next_attempt_time passed) of the `queryset` table queue in `ordering`.
+    Rows locked by another worker are skipped, and the next attempt of the taken ones is moved `lease` seconds
+    ahead, so parallel workers never get the same row and a crashed worker's rows are retried when it expires.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        due = queryset.select_for_update(skip_locked=True).filter(next_attempt_time__lte=now)
+        rows = list(due.order_by(*ordering)[:limit])
+        queryset.model.objects.filter(id__in=[row.id for row in rows]).update(
+            next_attempt_time=now + datetime.timedelta(seconds=lease)
+        )
+    return rows
+
+
+def retry_time(attempts, max_delay):
+    """Time of the next attempt after `attempts` failures: exponential backoff capped at `max_delay` seconds."""
+    return timezone.now() + datetime.timedelta(seconds=min(2 ** attempts, max_delay))
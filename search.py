@@ -0,0 +1,164 @@
+import re
+from abc import ABC, abstractmethod
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+from .models import Product
+
+SEARCH_TABLE = 'marketplace_product_search'
+
+
+class ProductSearchBackend(ABC):
+    """
+    Full-text index over Product.name, Product.keywords and Product.description.
+
+    The index lives in a side table keyed by product id, created on migrate (see apps.py) and updated
+    incrementally for saved and deleted products.
+    """
+
+    @abstractmethod
+    def create_index(self):
+        """Creates the side table and its indexes if they do not exist."""
+
+    @abstractmethod
+    def update(self, product_ids):
+        """Reindexes the products with `product_ids`, all products with None."""
+
+    @abstractmethod
+    def remove(self, product_ids):
+        """Drops the products with `product_ids` from the index."""
+
+    @abstractmethod
+    def search(self, queryset, query):
+        """Filters `queryset` by `query`, ranked backends order the matches by a `search_rank` annotation."""
+
+    def rebuild(self):
+        self.create_index()
+        self.update(None)
+
+
+class PostgresProductSearch(ProductSearchBackend):
+    """tsvector documents weighted name > keywords > description with a GIN index, ranked by ts_rank."""
+
+    def __init__(self):
+        self.config = getattr(settings, 'MARKETPLACE_SEARCH_CONFIG', 'russian')
+
+    def create_index(self):
+        with connection.cursor() as cursor:
+            # без внешнего ключа на товары: иначе flush и TransactionTestCase не могут очистить таблицу товаров
+            # (TRUNCATE), строки удаленных товаров убирает сигнал post_delete (remove)
+            cursor.execute(
+                f'CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} (product_id bigint PRIMARY KEY, document tsvector NOT NULL)'
+            )
+            cursor.execute(f'ALTER TABLE {SEARCH_TABLE} DROP CONSTRAINT IF EXISTS {SEARCH_TABLE}_product_id_fkey')
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {SEARCH_TABLE}_document ON {SEARCH_TABLE} USING gin (document)')
+
+    def update(self, product_ids):
+        sql = (
+            f'INSERT INTO {SEARCH_TABLE} (product_id, document) '
+            f"SELECT id, setweight(to_tsvector(%s::regconfig, coalesce(name, '')), 'A') || "
+            f"setweight(to_tsvector(%s::regconfig, coalesce(keywords, '')), 'B') || "
+            f"setweight(to_tsvector(%s::regconfig, coalesce(description, '')), 'C') "
+            f'FROM {Product._meta.db_table}'
+        )
+        params = [self.config] * 3
+        if product_ids is not None:
+            sql += ' WHERE id = ANY(%s)'
+            params.append(list(product_ids))
+        sql += ' ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document'
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def remove(self, product_ids):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE product_id = ANY(%s)', [list(product_ids)])
+
+    def search(self, queryset, query):
+        tsquery = 'websearch_to_tsquery(%s::regconfig, %s)'
+        matches = RawSQL(f'SELECT product_id FROM {SEARCH_TABLE} WHERE document @@ {tsquery}', [self.config, query])
+        rank = RawSQL(
+            f'SELECT ts_rank(document, {tsquery}) FROM {SEARCH_TABLE} '
+            f'WHERE product_id = {Product._meta.db_table}.id', [self.config, query]
+        )
+        return queryset.filter(id__in=matches).annotate(search_rank=rank).order_by('-search_rank', 'id')
+
+
+class SqliteProductSearch(ProductSearchBackend):
+    """FTS5 virtual table (rowid = product id), ranked by bm25 with the same column weights."""
+
+    def create_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} "
+                f"USING fts5(name, keywords, description, tokenize='unicode61')"
+            )
+
+    def update(self, product_ids):
+        sql = (
+            f'INSERT INTO {SEARCH_TABLE} (rowid, name, keywords, description) '
+            f'SELECT id, name, keywords, description FROM {Product._meta.db_table}'
+        )
+        if product_ids is None:
+            with connection.cursor() as cursor:
+                cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+                cursor.execute(sql)
+            return
+        product_ids = list(product_ids)
+        placeholders = ', '.join(['%s'] * len(product_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({placeholders})', product_ids)
+            cursor.execute(f'{sql} WHERE id IN ({placeholders})', product_ids)
+
+    def remove(self, product_ids):
+        product_ids = list(product_ids)
+        placeholders = ', '.join(['%s'] * len(product_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({placeholders})', product_ids)
+
+    @staticmethod
+    def match_expression(query):
+        # каждое слово ищется как префикс, операторы FTS5 из пользовательского ввода не применяются
+        words = re.findall(r'\w+', query)
+        return ' '.join(f'"{word}"*' for word in words)
+
+    def search(self, queryset, query):
+        expression = self.match_expression(query)
+        if not expression:
+            return queryset.none()
+        matches = RawSQL(f'SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s', [expression])
+        rank = RawSQL(
+            f'SELECT -bm25({SEARCH_TABLE}, 10.0, 5.0, 1.0) FROM {SEARCH_TABLE} '
+            f'WHERE {SEARCH_TABLE} MATCH %s AND rowid = {Product._meta.db_table}.id', [expression]
+        )
+        return queryset.filter(id__in=matches).annotate(search_rank=rank).order_by('-search_rank', 'id')
+
+
+class LikeProductSearch(ProductSearchBackend):
+    """Fallback for backends without a supported full-text index."""
+
+    def create_index(self):
+        pass
+
+    def update(self, product_ids):
+        pass
+
+    def remove(self, product_ids):
+        pass
+
+    def search(self, queryset, query):
+        for word in query.split():
+            queryset = queryset.filter(
+                Q(name__icontains=word) | Q(keywords__icontains=word) | Q(description__icontains=word)
+            )
+        return queryset
+
+
+def get_search_backend():
+    if connection.vendor == 'postgresql':
+        return PostgresProductSearch()
+    if connection.vendor == 'sqlite':
+        return SqliteProductSearch()
+    return LikeProductSearch()
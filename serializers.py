@@ -1,3 +1,7 @@
+from collections import OrderedDict
+
+from django.db import models
+from django.db.models import Prefetch
 from rest_framework import serializers
 
 from .models import Store
@@ -18,6 +22,50 @@ from .models import BundlePosition
 from .models import BundlePhoto
 from .models import DeliveryCost
 
+from .pricing import get_pricing
+
+
+def get_query_param_set(request, param):
+    if request is None or param not in request.query_params:
+        return None
+    return {name.strip() for value in request.query_params.getlist(param) for name in value.split(',') if name.strip()}
+
+
+class SparseFieldsMixin:
+    """
+    ?fields=a,b renders only the listed fields. `expandable_fields` (nested objects and computed values)
+    are rendered by default, but once ?expand= is passed only the expandable fields listed in it
+    (or in ?fields=) are. Applies to the top level serializer only.
+    """
+    expandable_fields = []
+
+    @classmethod
+    def is_field_requested(cls, name, request):
+        only = get_query_param_set(request, 'fields')
+        expand = get_query_param_set(request, 'expand')
+        if only is not None and name not in only and name not in (expand or ()):
+            return False
+        if name in cls.expandable_fields and expand is not None and name not in expand:
+            return only is not None and name in only
+        return True
+
+    def get_fields(self):
+        fields = super(SparseFieldsMixin, self).get_fields()
+        parent = self.parent
+        top_level = parent is None or isinstance(parent, serializers.ListSerializer) and parent.parent is None
+        request = self.context.get('request')
+        if not top_level or request is None:
+            return fields
+        return OrderedDict((name, field) for name, field in fields.items() if self.is_field_requested(name, request))
+
+
+class PricedListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        iterable = list(data.all() if isinstance(data, models.Manager) else data)
+        if 'cost_with_discount' in self.child.fields:
+            get_pricing(self.context).load(self.child.get_priced_product(item) for item in iterable)
+        return super(PricedListSerializer, self).to_representation(iterable)
+
 
 class StoreSerializer(serializers.ModelSerializer):
     class Meta:
@@ -34,35 +82,66 @@ class StoreContactSerializer(serializers.ModelSerializer):
 class CategorySerializer(serializers.ModelSerializer):
     nested = serializers.BooleanField(read_only=True)
 
+    @staticmethod
+    def setup_eager_loading(queryset, fields=None):
+        return queryset.with_nested()
+
     class Meta:
         model = Category
         fields = '__all__'
 
 
-class ProductSerializer(serializers.ModelSerializer):
-    _category = CategorySerializer(read_only=True)
-    _store = StoreSerializer(read_only=True)
+def photo_url(request, url):
+    return f"{request.META['wsgi.url_scheme']}://{request.META['HTTP_HOST']}{url}"
+
+
+def photo_urls(request, product):
+    return [photo_url(request, i.img.url) for i in product.productphoto_set.all()]
+
+
+class ProductSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    expandable_fields = ['_category', '_store', 'photos', 'cost_with_discount']
+    _category = CategorySerializer(read_only=True, source='category')
+    _store = StoreSerializer(read_only=True, source='store')
     cost = serializers.FloatField(read_only=True)
+    effective_cost = serializers.FloatField(read_only=True)
     photos = serializers.SerializerMethodField()
     cost_with_discount = serializers.SerializerMethodField()
 
+    def get_priced_product(self, instance):
+        return instance
+
     def get_cost_with_discount(self, instance):
-        return instance.dynamic_cost()
+        return get_pricing(self.context).cost_with_discount(instance)
 
     def get_photos(self, instance):
-        return [
-            f"{self.context['request'].META['wsgi.url_scheme']}://{self.context['request'].META['HTTP_HOST']}{i.img.url}"
-            for i in instance.productphoto_set.all()
-        ]
+        return photo_urls(self.context['request'], instance)
+
+    @staticmethod
+    def setup_eager_loading(queryset, fields=None):
+        if fields is None or '_store' in fields:
+            queryset = queryset.select_related('store')
+        if fields is None or '_category' in fields:
+            queryset = queryset.prefetch_related(
+                Prefetch('category', queryset=CategorySerializer.setup_eager_loading(Category.objects.all()))
+            )
+        if fields is None or 'photos' in fields:
+            queryset = queryset.prefetch_related('productphoto_set')
+        return queryset
 
     class Meta:
         model = Product
         fields = '__all__'
+        list_serializer_class = PricedListSerializer
 
 
 class ProductGroupSerializer(serializers.ModelSerializer):
     _store = StoreSerializer(read_only=True, source='store')
 
+    @staticmethod
+    def setup_eager_loading(queryset, fields=None):
+        return queryset.select_related('store')
+
     class Meta:
         model = ProductGroup
         fields = '__all__'
@@ -81,19 +160,29 @@ class ProductPropertySerializer(serializers.ModelSerializer):
 
 
 class CartPositionSerializer(serializers.ModelSerializer):
-    _product = ProductSerializer(read_only=True)
+    _product = ProductSerializer(read_only=True, source='product')
     cost = serializers.SerializerMethodField()
     cost_with_discount = serializers.SerializerMethodField()
 
+    def get_priced_product(self, instance):
+        return instance.product
+
     def get_cost_with_discount(self, instance):
-        return instance.product.dynamic_cost()
+        return get_pricing(self.context).cost_with_discount(instance.product)
 
     def get_cost(self, instance):
         return round(instance.product.cost * instance.count, 2)
 
+    @staticmethod
+    def setup_eager_loading(queryset, fields=None):
+        return queryset.prefetch_related(
+            Prefetch('product', queryset=ProductSerializer.setup_eager_loading(Product.objects.all()))
+        )
+
     class Meta:
         model = CartPosition
         fields = '__all__'
+        list_serializer_class = PricedListSerializer
 
 
 class CitySerializer(serializers.ModelSerializer):
@@ -114,52 +203,76 @@ class OrderAddressSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    expandable_fields = ['_store', '_address']
     _address = serializers.SlugRelatedField(read_only=True, slug_field='address', source='address')
-    _store = StoreSerializer(read_only=True)
+    _store = StoreSerializer(read_only=True, source='store')
     status = serializers.CharField(read_only=True)
+    state = serializers.CharField(read_only=True)
     amount = serializers.FloatField()
     created_time = serializers.DateTimeField(format='%d.%m.%Y %H:%M', read_only=True)
     canceled = serializers.BooleanField(read_only=True)
 
+    @staticmethod
+    def setup_eager_loading(queryset, fields=None):
+        related = [name for field, name in (('_address', 'address'), ('_store', 'store'))
+                   if fields is None or field in fields]
+        return queryset.select_related(*related) if related else queryset
+
     class Meta:
         model = Order
         fields = [
             'id', 'store', '_store', 'user', 'address', '_address', 'amount', 'created_time', 'paid', 'completed',
-            'delivered', 'canceled', 'status'
+            'delivered', 'canceled', 'state', 'status'
         ]
 
 
 class OrderAdminSerializer(serializers.ModelSerializer):
     address = serializers.SlugRelatedField(read_only=True, slug_field='address')
     status = serializers.CharField(read_only=True)
+    state = serializers.CharField(read_only=True)
     amount = serializers.FloatField(read_only=True)
     created_time = serializers.DateTimeField(format='%d.%m.%Y %H:%M', read_only=True)
     paid = serializers.BooleanField(read_only=True)
     canceled = serializers.BooleanField(read_only=True)
 
+    @staticmethod
+    def setup_eager_loading(queryset, fields=None):
+        return queryset.select_related('address')
+
     class Meta:
         model = Order
         fields = [
             'id', 'store', 'user', 'address', 'amount', 'created_time', 'paid', 'completed', 'delivered', 'canceled',
-            'status'
+            'state', 'status'
         ]
 
 
 class OrderPositionSerializer(serializers.ModelSerializer):
+    cost = serializers.FloatField(read_only=True)
+
     class Meta:
         model = OrderPosition
         fields = '__all__'
 
 
 class ProductAdminSerializer(serializers.ModelSerializer):
-    _category = CategorySerializer(read_only=True)
-    _store = StoreSerializer(read_only=True)
+    _category = CategorySerializer(read_only=True, source='category')
+    _store = StoreSerializer(read_only=True, source='store')
     cost = serializers.FloatField()
+    effective_cost = serializers.FloatField(read_only=True)
     photos = serializers.SerializerMethodField()
     moderator_confirmed = serializers.SlugRelatedField(read_only=True, slug_field='moderator_confirmed',
                                                        source='category')
     blocked = serializers.BooleanField(read_only=True)
+    is_visible = serializers.BooleanField(read_only=True)
+
+    def get_photos(self, instance):
+        return photo_urls(self.context['request'], instance)
+
+    @staticmethod
+    def setup_eager_loading(queryset, fields=None):
+        return ProductSerializer.setup_eager_loading(queryset, fields)
 
     class Meta:
         model = Product
@@ -180,6 +293,10 @@ class DiscountSerializer(serializers.ModelSerializer):
 
     _product = serializers.SlugRelatedField(read_only=True, slug_field="name", source="product")
 
+    @staticmethod
+    def setup_eager_loading(queryset, fields=None):
+        return queryset.select_related("product")
+
     class Meta:
         model = Discount
         fields = "__all__"
@@ -196,6 +313,10 @@ class BundlePositionSerializer(serializers.ModelSerializer):
 
     _product = serializers.SlugRelatedField(read_only=True, slug_field="name", source="product")
 
+    @staticmethod
+    def setup_eager_loading(queryset, fields=None):
+        return queryset.select_related("product")
+
     class Meta:
         model = BundlePosition
         fields = "__all__"
@@ -206,16 +327,81 @@ class DeliveryCostSerializer(serializers.ModelSerializer):
     _store = serializers.SlugRelatedField(read_only=True, slug_field="name", source="store")
     _city = serializers.SlugRelatedField(read_only=True, slug_field="name", source="city")
 
+    @staticmethod
+    def setup_eager_loading(queryset, fields=None):
+        return queryset.select_related("store", "city")
+
     class Meta:
         model = DeliveryCost
         fields = "__all__"
 
 
+class ProductDetailSerializer(ProductSerializer):
+    """
+    Product card: the product with its properties, active discount, store contacts and the delivery cost
+    of its store to the city passed to setup_eager_loading.
+    """
+    expandable_fields = ProductSerializer.expandable_fields + ['properties', 'discount', 'contacts', 'delivery']
+    properties = ProductPropertySerializer(many=True, read_only=True, source='productproperty_set')
+    discount = serializers.SerializerMethodField()
+    contacts = StoreContactSerializer(many=True, read_only=True, source='store.storecontact_set')
+    delivery = serializers.SerializerMethodField()
+
+    def get_discount(self, instance):
+        discount = get_pricing(self.context).discount(instance)
+        if discount is None:
+            return None
+        discount.product = instance
+        return DiscountSerializer(discount, context=self.context).data
+
+    def get_delivery(self, instance):
+        delivery_costs = getattr(instance.store, 'city_delivery_costs', None)
+        if not delivery_costs:
+            return None
+        return DeliveryCostSerializer(delivery_costs[0], context=self.context).data
+
+    @staticmethod
+    def setup_eager_loading(queryset, fields=None, city_id=None):
+        queryset = ProductSerializer.setup_eager_loading(queryset, fields).select_related('store')
+        if fields is None or 'properties' in fields:
+            queryset = queryset.prefetch_related('productproperty_set')
+        if fields is None or 'contacts' in fields:
+            queryset = queryset.prefetch_related('store__storecontact_set')
+        if city_id is not None and (fields is None or 'delivery' in fields):
+            queryset = queryset.prefetch_related(Prefetch(
+                'store__delivery_costs', queryset=DeliveryCost.objects.filter(city_id=city_id).select_related('city'),
+                to_attr='city_delivery_costs'
+            ))
+        return queryset
+
+
 class BundlePhotoSerializer(serializers.ModelSerializer):
 
     _bundle = serializers.SlugRelatedField(read_only=True, slug_field="title", source="bundle")
 
+    @staticmethod
+    def setup_eager_loading(queryset, fields=None):
+        return queryset.select_related("bundle")
+
     class Meta:
         model = BundlePhoto
         fields = "__all__"
 
+
+class StoreSalesSerializer(serializers.Serializer):
+    """Store sales of a day (StoreSalesDay row) or of a period (aggregate of the rows, without date)."""
+    date = serializers.DateField(required=False)
+    orders = serializers.IntegerField()
+    revenue = serializers.FloatField()
+    units = serializers.IntegerField()
+    canceled_orders = serializers.IntegerField()
+    delivered_orders = serializers.IntegerField()
+
+
+class ProductSalesSerializer(serializers.Serializer):
+    product = serializers.IntegerField(source='product_id')
+    name = serializers.CharField(source='product__name')
+    orders = serializers.IntegerField()
+    revenue = serializers.FloatField()
+    units = serializers.IntegerField()
+    canceled_units = serializers.IntegerField()
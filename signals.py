@@ -0,0 +1,120 @@
+from django.db.models.signals import pre_save, post_save, post_delete, post_migrate
+from django.dispatch import receiver
+
+from .models import Store
+from .models import StoreContact
+from .models import Category
+from .models import Product
+from .models import ProductPhoto
+from .models import ProductProperty
+from .models import City
+from .models import OrderAddress
+from .models import Discount
+from .models import DeliveryCost
+from .models import Order
+from .models import OrderPosition
+
+from .pricing import refresh_effective_costs
+
+from .analytics import mark_sales_stale
+
+from .search import get_search_backend
+
+from .caching import touch
+
+# таблицы, версии которых используют кэш ответов и ETag (mixins.ResponseCacheMixin, mixins.ConditionalGetMixin)
+CACHED_MODELS = (
+    Store, StoreContact, Category, Product, ProductPhoto, ProductProperty, City, Discount, OrderAddress, DeliveryCost
+)
+
+
+@receiver(post_migrate)
+def create_search_index(sender, **kwargs):
+    if sender.name == 'marketplace':
+        get_search_backend().create_index()
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, **kwargs):
+    refresh_effective_costs(Product.objects.filter(id=instance.id))
+    Product.objects.filter(id=instance.id).refresh_visibility()
+    # поля пересчитаны запросами UPDATE, сохраненный объект (ответ API) получает их значения
+    instance.refresh_from_db(fields=['effective_cost', 'is_visible'])
+    get_search_backend().update([instance.id])
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    get_search_backend().remove([instance.id])
+
+
+@receiver(post_save, sender=Store)
+def store_saved(sender, instance, **kwargs):
+    Product.objects.filter(store_id=instance.id).refresh_visibility()
+
+
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, **kwargs):
+    instance.refresh_path()
+    Product.objects.filter(category_id=instance.id).refresh_visibility()
+
+
+@receiver(post_delete, sender=Category)
+def category_deleted(sender, instance, **kwargs):
+    # подкатегории и товары удаленной категории к этому моменту уже отвязаны от нее (SET_NULL),
+    # подкатегории становятся корнями своих поддеревьев
+    if instance.path:
+        Category.objects.move_subtree(instance.path, '')
+    Product.objects.filter(category__isnull=True).refresh_visibility()
+
+
+@receiver(pre_save, sender=Discount)
+def discount_changing(sender, instance, **kwargs):
+    # запоминаем прежний товар, чтобы пересчитать его цену, если скидку перенесли на другой товар
+    instance.previous_product_id = None
+    if instance.pk:
+        instance.previous_product_id = Discount.objects.filter(pk=instance.pk).values_list(
+            'product_id', flat=True).first()
+
+
+@receiver(post_save, sender=Discount)
+def discount_saved(sender, instance, **kwargs):
+    product_ids = {instance.product_id, getattr(instance, 'previous_product_id', None)} - {None}
+    refresh_effective_costs(Product.objects.filter(id__in=product_ids))
+
+
+@receiver(post_delete, sender=Discount)
+def discount_deleted(sender, instance, **kwargs):
+    refresh_effective_costs(Product.objects.filter(id=instance.product_id))
+
+
+@receiver(post_save, sender=Order)
+def order_saved(sender, instance, created, **kwargs):
+    # новый неоплаченный заказ в продажи не входит
+    if created and instance.state == Order.AWAITING_PAYMENT:
+        return
+    mark_sales_stale([instance])
+
+
+@receiver(post_delete, sender=Order)
+def order_deleted(sender, instance, **kwargs):
+    mark_sales_stale([instance])
+
+
+@receiver(post_save, sender=OrderPosition)
+@receiver(post_delete, sender=OrderPosition)
+def order_position_changed(sender, instance, **kwargs):
+    order = Order.objects.filter(id=instance.order_id).first()
+    if order is not None and (order.paid or order.canceled):
+        mark_sales_stale([order])
+
+
+def catalog_changed(sender, **kwargs):
+    touch(sender)
+
+
+# обработчик подключается к каждой модели отдельно: обработчик post_delete без sender отключает быстрое
+# удаление (DELETE без SELECT) у всех моделей проекта
+for model in CACHED_MODELS:
+    post_save.connect(catalog_changed, sender=model)
+    post_delete.connect(catalog_changed, sender=model)
@@ -1,3 +1,849 @@
-from django.test import TestCase
+import datetime
+import io
+import itertools
+import threading
+from decimal import Decimal
+from unittest import mock, skipIf
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, force_authenticate
+from rest_framework.utils import json, encoders
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from .models import Store
+from .models import Category
+from .models import Product
+from .models import ProductPhoto
+from .models import City
+from .models import Discount
+from .models import CartPosition
+from .models import OrderAddress
+from .models import Order
+from .models import OrderPosition
+from .models import StoreSalesDay
+from .models import ProductSalesDay
+from .models import StaleSalesDay
+from .models import PaymentOutbox
+from .models import PaymentNotification
+from .models import PushNotification
+
+from .serializers import StoreSerializer
+from .serializers import ProductSerializer
+
+from .values_serializers import StoreValuesSerializer
+from .values_serializers import ProductValuesSerializer
+
+from .admin import OrderAdmin
+
+from .caching import get_cache
+from .caching import get_versions
+
+from .search import SEARCH_TABLE
+
+from .carts import MemoryCartStorage
+from .carts import RedisCartStorage
+
+from .analytics import rebuild_stale_sales
+
+from . import notifications
+from .notifications import FakePushSender
+from .notifications import claim_pushes
+from .notifications import enqueue_push
+from .notifications import process_push_queue
+
+from .payments import FakePaymentProvider
+from .payments import claim_notifications
+from .payments import claim_payments
+from .payments import enqueue_payment
+from .payments import process_payment_outbox
+from .payments import process_payment_notifications
+from .payments import record_notification
+
+from .views import ProductViewSet
+from .views import CartPositionViewSet
+from .views import ProductAdminViewSet
+from .views import OrderViewSet
+from .views import OrderAdminViewSet
+
+
+def create_store(user, name='store', city=None):
+    return Store.objects.create(user=user, name=name, logo=f'stores/{name}/logo.png', city=city,
+                                moderator_confirmed=True)
+
+
+def create_product(store, name, cost, count=10, category=None):
+    return Product.objects.create(store=store, name=name, cost=Decimal(cost), count=count, category=category,
+                                  code=name)
+
+
+def create_buyer(username):
+    user = get_user_model().objects.create_user(username=username, password='password')
+    address = OrderAddress.objects.create(user=user, address='ул. Тестовая, 1', longitude=1, latitude=1)
+    return user, address
+
+
+def call_action(viewset, action, user, method='post', data=None, **kwargs):
+    request = getattr(APIRequestFactory(), method)('/', data or {}, format='json')
+    force_authenticate(request, user)
+    return viewset.as_view({method: action})(request, **kwargs)
+
+
+def create_order(user, store, address):
+    return call_action(OrderViewSet, 'create_order', user, data={'store': store.id, 'address': address.id})
+
+
+class ValuesSerializerParityTests(TestCase):
+    """The values() fast path must render exactly what the regular serializers render."""
+
+    @classmethod
+    def setUpTestData(cls):
+        user = get_user_model().objects.create_user(username='seller', password='password')
+        city = City.objects.create(name='Город', longitude=1, latitude=1)
+        root = Category.objects.create(name='root', moderator_confirmed=True)
+        leaf = Category.objects.create(name='leaf', category=root, moderator_confirmed=True)
+        store = create_store(user, city=city)
+        create_store(user, name='no-city')
+        now = timezone.now()
+
+        discounted = create_product(store, 'discounted', '200.00', category=leaf)
+        Discount.objects.create(user=user, product=discounted, discount_value=Decimal('15.00'),
+                                date_start=now - datetime.timedelta(days=1), date_end=now + datetime.timedelta(days=1))
+        ProductPhoto.objects.create(product=discounted, img='products/1.png')
+        ProductPhoto.objects.create(product=discounted, img='products/2.png')
+
+        expired = create_product(store, 'expired discount', '150.00', category=root)
+        Discount.objects.create(user=user, product=expired, discount_value=Decimal('50.00'),
+                                date_start=now - datetime.timedelta(days=3), date_end=now - datetime.timedelta(days=1))
+        ProductPhoto.objects.create(product=expired, img='products/3.png')
+
+        create_product(store, 'no photos', '99.90', category=leaf)
+        create_product(store, 'no category', '10.00')
+
+    def setUp(self):
+        self.factory = APIRequestFactory()
+
+    def render(self, serializer_class, values_serializer_class, queryset, params=None):
+        request = Request(self.factory.get('/', params or {}, HTTP_HOST='testserver'))
+        if hasattr(serializer_class, 'setup_eager_loading'):
+            queryset = serializer_class.setup_eager_loading(queryset)
+        regular = serializer_class(queryset, many=True, context={'request': request}).data
+
+        request = Request(self.factory.get('/', params or {}, HTTP_HOST='testserver'))
+        values_serializer = values_serializer_class(context={'request': request})
+        values = values_serializer.to_representation(values_serializer.get_queryset(queryset))
+        return self.normalize(regular), self.normalize(values)
+
+    @staticmethod
+    def normalize(data):
+        return json.loads(json.dumps(data, cls=encoders.JSONEncoder))
+
+    def assertSameRows(self, regular, values):
+        self.assertEqual(len(regular), len(values))
+        for expected, actual in zip(regular, values):
+            self.assertEqual(list(expected), list(actual))
+            for name in expected:
+                self.assertEqual(expected[name], actual[name], f'field {name} of product {expected.get("id")}')
+
+    def test_products(self):
+        regular, values = self.render(ProductSerializer, ProductValuesSerializer, Product.objects.order_by('id'))
+        self.assertSameRows(regular, values)
+
+        rows = {row['name']: row for row in values}
+        self.assertEqual(rows['discounted']['cost_with_discount'], 170.0)
+        self.assertEqual(len(rows['discounted']['photos']), 2)
+        self.assertIsNone(rows['expired discount']['cost_with_discount'])
+        self.assertEqual(rows['no photos']['photos'], [])
+        self.assertTrue(rows['expired discount']['_category']['nested'])
+        self.assertFalse(rows['discounted']['_category']['nested'])
+        self.assertIsNone(rows['no category']['_category'])
+        self.assertEqual(rows['discounted']['_store']['name'], 'store')
+
+    def test_products_sparse_fields(self):
+        for params in ({'fields': 'id,cost_with_discount'}, {'expand': '_store'}, {'fields': 'id', 'expand': 'photos'}):
+            regular, values = self.render(
+                ProductSerializer, ProductValuesSerializer, Product.objects.order_by('id'), params
+            )
+            self.assertSameRows(regular, values)
+
+    def test_stores(self):
+        regular, values = self.render(StoreSerializer, StoreValuesSerializer, Store.objects.order_by('id'))
+        self.assertSameRows(regular, values)
+        self.assertIsNone(values[1]['city'])
+
+    def test_benchmark_command(self):
+        out = io.StringIO()
+        call_command('benchmark_values_serializers', rows=5, repeat=1, stdout=out)
+        self.assertIn('Товары, 5 строк', out.getvalue())
+        self.assertIn('Магазины, 5 строк', out.getvalue())
+        # данные замера откатываются
+        self.assertFalse(Product.objects.filter(name__startswith='benchmark-').exists())
+
+    def test_products_query_count(self):
+        # страница любого размера: строки, фотографии и скидки - три запроса
+        store = Store.objects.get(name='store')
+        for index in range(20):
+            create_product(store, f'extra {index}', '1.00')
+        request = Request(self.factory.get('/', HTTP_HOST='testserver'))
+        values_serializer = ProductValuesSerializer(context={'request': request})
+        queryset = values_serializer.get_queryset(Product.objects.order_by('id'))
+        with self.assertNumQueries(3):
+            self.assertEqual(len(values_serializer.to_representation(queryset)), 24)
+
+
+class ProductSearchPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = get_user_model().objects.create_user(username='seller', password='password')
+        category = Category.objects.create(name='category', moderator_confirmed=True)
+        store = create_store(user)
+        for index in range(3):
+            create_product(store, f'chair {index}', f'{index + 1}0.00', category=category)
+
+    def list(self, params):
+        return call_action(ProductViewSet, 'list', None, method='get', data=params)
+
+    def test_deleted_product_leaves_the_index(self):
+        product_id = Product.objects.get(name='chair 0').id
+        Product.objects.filter(id=product_id).delete()
+        with connection.cursor() as cursor:
+            column = 'product_id' if connection.vendor == 'postgresql' else 'rowid'
+            cursor.execute(f'SELECT COUNT(*) FROM {SEARCH_TABLE} WHERE {column} = %s', [product_id])
+            self.assertEqual(cursor.fetchone()[0], 0)
+        self.assertEqual(self.list({'search': 'chair'}).data['count'], 2)
+
+    def test_cursor_with_relevance_order_is_rejected(self):
+        response = self.list({'search': 'chair', 'cursor': ''})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('cursor', response.data)
+
+    def test_cursor_with_explicit_ordering(self):
+        response = self.list({'search': 'chair', 'cursor': '', 'ordering': '-cost', 'page_size': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['name'] for row in response.data['results']], ['chair 2', 'chair 1'])
+        self.assertIsNotNone(response.data['next'])
+
+        response = self.list({'search': 'chair', 'page_size': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 3)
+
+
+class QueryCountTests(TestCase):
+    """List pages and cards take a constant number of queries whatever the page size."""
+
+    @classmethod
+    def setUpTestData(cls):
+        seller = get_user_model().objects.create_user(username='seller', password='password')
+        city = City.objects.create(name='Город', longitude=1, latitude=1)
+        root = Category.objects.create(name='root', moderator_confirmed=True)
+        now = timezone.now()
+        cls.buyer, cls.address = create_buyer('buyer')
+        for index in range(12):
+            store = create_store(seller, name=f'store {index}', city=city)
+            category = Category.objects.create(name=f'category {index}', category=root, moderator_confirmed=True)
+            for number in range(5):
+                product = create_product(store, f'product {index} {number}', '10.00', category=category)
+                ProductPhoto.objects.create(product=product, img=f'products/{product.id}.png')
+                if number % 2:
+                    Discount.objects.create(user=seller, product=product, discount_value=10,
+                                            date_start=now - datetime.timedelta(days=1),
+                                            date_end=now + datetime.timedelta(days=1))
+                CartPosition.objects.create(user=cls.buyer, product=product, count=1)
+            Order.objects.create(store=store, user=cls.buyer, address=cls.address, amount=10)
+        cls.product = Product.objects.order_by('id').first()
+
+    def setUp(self):
+        # ответы списков кэшируются (ResponseCacheMixin)
+        get_cache().clear()
+
+    def assertConstantQueries(self, viewset, action, queries, params=None, **kwargs):
+        for page_size in (5, 50):
+            request = APIRequestFactory().get('/', dict(params or {}, page_size=page_size), HTTP_HOST='testserver')
+            force_authenticate(request, self.buyer)
+            with self.assertNumQueries(queries):
+                response = viewset.as_view({'get': action})(request, **kwargs)
+            self.assertEqual(response.status_code, 200)
+            results = response.data['results'] if 'results' in response.data else response.data
+            if isinstance(results, list):
+                self.assertGreaterEqual(len(results), min(page_size, 12))
+
+    def test_product_list(self):
+        self.assertConstantQueries(ProductViewSet, 'list', 5)
+
+    def test_product_keyset_list(self):
+        self.assertConstantQueries(ProductViewSet, 'list', 5, {'cursor': ''})
+
+    def test_product_details(self):
+        self.assertConstantQueries(ProductViewSet, 'details', 4, {'city': '1'}, pk=self.product.id)
+
+    def test_cart(self):
+        self.assertConstantQueries(CartPositionViewSet, 'list', 6)
+        self.assertConstantQueries(CartPositionViewSet, 'by_stores', 5)
+
+    def test_order_list(self):
+        self.assertConstantQueries(OrderViewSet, 'list', 3)
+
+
+class CatalogSignalTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user(username='seller', password='password')
+        cls.store = create_store(cls.user)
+
+    def test_catalog_changes_touch_versions(self):
+        before = get_versions([Product])[Product._meta.label_lower]
+        product = create_product(self.store, 'product', '1.00')
+        after = get_versions([Product])[Product._meta.label_lower]
+        self.assertGreater(after, before)
+        product.delete()
+        self.assertGreater(get_versions([Product])[Product._meta.label_lower], after)
+
+    def test_saved_product_has_computed_fields(self):
+        category = Category.objects.create(name='category', moderator_confirmed=True)
+        response = call_action(ProductAdminViewSet, 'create', self.user, data={
+            'name': 'product', 'store': self.store.id, 'category': category.id, 'cost': 10, 'code': 'p', 'count': 1
+        })
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data['is_visible'], response.data['effective_cost']), (True, 10.0))
+
+    def test_models_without_receivers_are_fast_deleted(self):
+        product = create_product(self.store, 'product', '1.00')
+        for index in range(3):
+            CartPosition.objects.create(tmp_user_code=f'code {index}', product=product)
+        # один DELETE без предварительного SELECT
+        with self.assertNumQueries(1):
+            self.assertEqual(CartPosition.objects.filter(product=product).delete()[0], 3)
+
+
+class CartStorageTestsMixin:
+    """Cart operations of an anonymous ?tmp= cart and its merge on login, run against every storage."""
+
+    @classmethod
+    def setUpTestData(cls):
+        seller = get_user_model().objects.create_user(username='seller', password='password')
+        store = create_store(seller)
+        cls.chair = create_product(store, 'chair', '10.00', count=5)
+        cls.table = create_product(store, 'table', '30.00', count=5)
+
+    def call(self, action, data=None, method='post', user=None, tmp='cart'):
+        request = getattr(APIRequestFactory(), method)(f'/?tmp={tmp}' if tmp else '/', data or {}, format='json')
+        if user is not None:
+            force_authenticate(request, user)
+        return CartPositionViewSet.as_view({method: action})(request)
+
+    def cart(self, **kwargs):
+        return {row['product']: row['count'] for row in self.call('list', method='get', **kwargs).data['results']}
+
+    def test_change(self):
+        self.assertEqual(self.call('change', {'product': self.chair.id, 'count': 0}).status_code, 400)
+        self.assertEqual(self.call('change', {'product': self.chair.id, 'count': 2}).status_code, 200)
+        self.assertEqual(self.call('change', {'product': self.table.id, 'count': 1}).status_code, 200)
+        self.assertEqual(self.cart(), {self.chair.id: 2, self.table.id: 1})
+        self.assertEqual(self.call('amount', method='get').data['amount'], Decimal('50.00'))
+
+        self.call('change', {'product': self.chair.id, 'count': 3})
+        self.call('change', {'product': self.table.id, 'count': -1})
+        self.assertEqual(self.cart(), {self.chair.id: 3})
+        self.assertEqual(self.cart(tmp='other'), {})
+
+    def test_batch(self):
+        response = self.call('batch', {'positions': [
+            {'product': self.chair.id, 'count': 1}, {'product': self.table.id, 'count': 2},
+            {'product': self.chair.id, 'count': 4},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.cart(), {self.chair.id: 4, self.table.id: 2})
+
+        self.call('batch', {'positions': [{'product': self.table.id, 'count': 0}]})
+        self.assertEqual(self.cart(), {self.chair.id: 4})
+        response = self.call('batch', {'positions': [{'product': self.chair.id + self.table.id, 'count': 1}]})
+        self.assertEqual(response.status_code, 400)
+
+    def test_sync_merges_into_the_user_cart(self):
+        buyer, address = create_buyer('buyer')
+        CartPosition.objects.create(user=buyer, product=self.chair, count=4)
+        self.call('batch', {'positions': [
+            {'product': self.chair.id, 'count': 3}, {'product': self.table.id, 'count': 1}
+        ]})
+
+        response = self.call('sync', {'tmp': 'cart'}, user=buyer, tmp=None)
+        self.assertEqual(response.status_code, 200)
+        # количество ограничено остатком товара
+        self.assertEqual(dict(buyer.cartposition_set.values_list('product_id', 'count')),
+                         {self.chair.id: 5, self.table.id: 1})
+        self.assertEqual(self.cart(), {})
+        self.assertEqual(self.call('sync', {'tmp': 'cart'}, tmp=None).status_code, 403)
+
+
+class DatabaseCartStorageTests(CartStorageTestsMixin, TestCase):
+    def test_purge_anonymous_carts(self):
+        buyer, address = create_buyer('buyer')
+        old = timezone.now() - datetime.timedelta(days=40)
+        for code in ('abandoned', 'active'):
+            CartPosition.objects.create(tmp_user_code=code, product=self.chair)
+            CartPosition.objects.create(tmp_user_code=code, product=self.table)
+        CartPosition.objects.create(user=buyer, product=self.chair)
+        CartPosition.objects.update(updated_time=old)
+        # одна свежая позиция сохраняет всю корзину
+        CartPosition.objects.filter(tmp_user_code='active', product=self.table).update(updated_time=timezone.now())
+
+        call_command('purge_anonymous_carts', days=30, batch_size=1, stdout=io.StringIO())
+        self.assertEqual(sorted(CartPosition.objects.values_list('tmp_user_code', flat=True)), ['', 'active', 'active'])
+
+
+@override_settings(MARKETPLACE_CART_STORAGE='memory')
+class MemoryCartStorageTests(CartStorageTestsMixin, TestCase):
+    def setUp(self):
+        MemoryCartStorage.carts.clear()
+
+    def test_expired_cart_is_empty(self):
+        storage = MemoryCartStorage()
+        storage.apply_counts('cart', {self.chair.id: 1})
+        storage.timeout = -1
+        storage.apply_counts('expired', {self.chair.id: 1})
+        self.assertEqual((storage.get('cart'), storage.get('expired')), ({self.chair.id: 1}, {}))
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+@override_settings(MARKETPLACE_CART_STORAGE='redis', MARKETPLACE_CART_REDIS_URL='redis://fake/0')
+class RedisCartStorageTests(CartStorageTestsMixin, TestCase):
+    def setUp(self):
+        RedisCartStorage.clients['redis://fake/0'] = fakeredis.FakeRedis()
+        self.addCleanup(RedisCartStorage.clients.pop, 'redis://fake/0')
+
+    def test_cart_expires(self):
+        self.call('change', {'product': self.chair.id, 'count': 1})
+        self.assertGreater(RedisCartStorage().client.ttl('marketplace:cart:cart'), 0)
+
+
+class StockReservationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = get_user_model().objects.create_user(username='seller', password='password')
+        cls.store = create_store(cls.seller)
+        cls.product = create_product(cls.store, 'last units', '100.00', count=3)
+        cls.other = create_product(cls.store, 'plenty', '10.00', count=50)
+
+    def test_competing_checkouts(self):
+        first, first_address = create_buyer('first')
+        second, second_address = create_buyer('second')
+        CartPosition.objects.create(user=first, product=self.product, count=2)
+        CartPosition.objects.create(user=second, product=self.product, count=2)
+
+        self.assertEqual(create_order(first, self.store, first_address).status_code, 201)
+        response = create_order(second, self.store, second_address)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['products'], [self.product.id])
+
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.count, 1)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_short_position_rolls_back_the_others(self):
+        self.assertEqual(Product.objects.reserve({self.other.id: 5, self.product.id: 4}), [self.product.id])
+        self.assertEqual(Product.objects.get(id=self.other.id).count, 50)
+
+        buyer, address = create_buyer('buyer')
+        CartPosition.objects.create(user=buyer, product=self.other, count=5)
+        CartPosition.objects.create(user=buyer, product=self.product, count=4)
+        self.assertEqual(create_order(buyer, self.store, address).status_code, 400)
+        self.assertEqual(dict(Product.objects.values_list('id', 'count')), {self.product.id: 3, self.other.id: 50})
+        self.assertFalse(Order.objects.exists())
+
+    def test_cancel_releases_stock_once(self):
+        buyer, address = create_buyer('buyer')
+        CartPosition.objects.create(user=buyer, product=self.product, count=3)
+        CartPosition.objects.create(user=buyer, product=self.other, count=10)
+        order_id = create_order(buyer, self.store, address).data['id']
+        self.assertEqual(dict(Product.objects.values_list('id', 'count')), {self.product.id: 0, self.other.id: 40})
+
+        self.assertEqual(call_action(OrderAdminViewSet, 'cancel', self.seller, pk=order_id).status_code, 200)
+        self.assertEqual(call_action(OrderAdminViewSet, 'cancel', self.seller, pk=order_id).status_code, 400)
+        self.assertEqual(dict(Product.objects.values_list('id', 'count')), {self.product.id: 3, self.other.id: 50})
+
+
+@override_settings(MARKETPLACE_PAYMENT_PROVIDER='fake')
+class OrderPricingTests(TestCase):
+    """Orders and payments are priced with the discounts the cart shows."""
+
+    @classmethod
+    def setUpTestData(cls):
+        seller = get_user_model().objects.create_user(username='seller', password='password')
+        cls.store = create_store(seller)
+        cls.discounted = create_product(cls.store, 'discounted', '50.00')
+        cls.regular = create_product(cls.store, 'regular', '10.00')
+        now = timezone.now()
+        Discount.objects.create(user=seller, product=cls.discounted, discount_value=Decimal('50.00'),
+                                date_start=now - datetime.timedelta(days=1), date_end=now + datetime.timedelta(days=1))
+
+    def setUp(self):
+        FakePaymentProvider.payments.clear()
+
+    def test_order_is_charged_the_cart_amount(self):
+        buyer, address = create_buyer('buyer')
+        CartPosition.objects.create(user=buyer, product=self.discounted, count=1)
+        CartPosition.objects.create(user=buyer, product=self.regular, count=2)
+        cart_amount = call_action(CartPositionViewSet, 'amount', buyer, method='get').data['amount']
+        self.assertEqual(cart_amount, Decimal('45.00'))
+
+        order = Order.objects.get(id=create_order(buyer, self.store, address).data['id'])
+        self.assertEqual(order.amount, cart_amount)
+        self.assertEqual(dict(order.orderposition_set.values_list('product_id', 'cost')),
+                         {self.discounted.id: Decimal('25.00'), self.regular.id: Decimal('10.00')})
+
+        self.assertEqual(process_payment_outbox(), (1, 0))
+        payment, = FakePaymentProvider.payments.values()
+        self.assertEqual(payment['amount']['value'], '45.00')
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrentCheckoutTests(TransactionTestCase):
+    """Parallel checkouts of the last units: rows are locked, so exactly one of them gets the stock."""
+    buyers = 8
+
+    def test_last_units(self):
+        seller = get_user_model().objects.create_user(username='seller', password='password')
+        store = create_store(seller)
+        product = create_product(store, 'last units', '100.00', count=3)
+        buyers = list()
+        for index in range(self.buyers):
+            user, address = create_buyer(f'buyer {index}')
+            CartPosition.objects.create(user=user, product=product, count=3)
+            buyers.append((user, address))
+
+        barrier = threading.Barrier(self.buyers)
+        statuses = list()
+
+        def checkout(user, address):
+            try:
+                barrier.wait()
+                statuses.append(create_order(user, store, address).status_code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=checkout, args=buyer) for buyer in buyers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(statuses), [201] + [400] * (self.buyers - 1))
+        self.assertEqual(Product.objects.get(id=product.id).count, 0)
+        self.assertEqual(Order.objects.count(), 1)
+
+
+class OrderStateTests(TestCase):
+    flags = ['paid', 'canceled', 'completed', 'delivered']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = get_user_model().objects.create_user(username='seller', password='password')
+        cls.store = create_store(cls.seller)
+        cls.buyer, cls.address = create_buyer('buyer')
+
+    def create_order(self, **flags):
+        return Order.objects.create(store=self.store, user=self.buyer, address=self.address, amount=1, **flags)
+
+    def assertStateMatchesFlags(self, order):
+        order.refresh_from_db()
+        self.assertEqual(order.state, order.get_state(), {flag: getattr(order, flag) for flag in self.flags})
+
+    def test_update_keeps_state(self):
+        order = self.create_order()
+        self.assertEqual(order.state, Order.AWAITING_PAYMENT)
+        orders = Order.objects.filter(id=order.id)
+        for start in itertools.product([False, True], repeat=len(self.flags)):
+            for changes in itertools.product([None, False, True], repeat=len(self.flags)):
+                orders.update(**dict(zip(self.flags, start)))
+                changes = {flag: value for flag, value in zip(self.flags, changes) if value is not None}
+                if changes:
+                    orders.update(**changes)
+                self.assertStateMatchesFlags(order)
+
+    def test_lifecycle(self):
+        order = self.create_order()
+        orders = Order.objects.filter(id=order.id)
+        for changes, state in (({'paid': True}, Order.ASSEMBLING), ({'completed': True}, Order.DELIVERING),
+                               ({'delivered': True}, Order.DELIVERED), ({'canceled': True}, Order.CANCELED)):
+            orders.update(**changes)
+            order.refresh_from_db()
+            self.assertEqual(order.state, state)
+
+    def test_save_keeps_state(self):
+        order = self.create_order(paid=True)
+        self.assertEqual(order.state, Order.ASSEMBLING)
+        order.canceled = True
+        order.save(update_fields=['canceled'])
+        self.assertStateMatchesFlags(order)
+        self.assertEqual(order.state, Order.CANCELED)
+
+    def test_refresh_state(self):
+        orders = [self.create_order(paid=True), self.create_order(canceled=True), self.create_order()]
+        Order.objects.update(state=Order.DELIVERED)
+        self.assertEqual(Order.objects.all().refresh_state(), 3)
+        self.assertEqual(Order.objects.all().refresh_state(), 0)
+        for order in orders:
+            self.assertStateMatchesFlags(order)
+
+    def test_admin_sorts_by_lifecycle(self):
+        for flags in ({'canceled': True}, {'paid': True, 'completed': True, 'delivered': True}, {'paid': True}, {}):
+            self.create_order(**flags)
+        ordering = OrderAdmin.status.admin_order_field
+        self.assertEqual(
+            list(Order.objects.order_by(ordering).values_list('state', flat=True)),
+            [Order.AWAITING_PAYMENT, Order.ASSEMBLING, Order.DELIVERED, Order.CANCELED]
+        )
+
+    def test_listing_queries_use_indexes(self):
+        indexes = {tuple(index.fields): index.name for index in Order._meta.indexes}
+        for index in range(30):
+            self.create_order(paid=index % 2 == 0, payment_id=f'payment-{index}')
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # на маленькой таблице планировщик иначе выбирает последовательное чтение
+                cursor.execute('SET LOCAL enable_seqscan = off')
+            elif connection.vendor == 'sqlite':
+                cursor.execute('ANALYZE')
+
+        queries = (
+            (('store', 'state', 'created_time'),
+             Order.objects.filter(store=self.store, state=Order.ASSEMBLING).order_by('-created_time')),
+            (('user', 'created_time'), Order.objects.filter(user=self.buyer).order_by('-created_time')),
+            (('payment_id',), Order.objects.filter(payment_id='payment-7')),
+        )
+        for fields, queryset in queries:
+            self.assertIn(indexes[fields], queryset.explain(), fields)
+
+
+class SalesRollupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seller = get_user_model().objects.create_user(username='seller', password='password')
+        cls.store = create_store(seller)
+        cls.product = create_product(cls.store, 'product', '100.00')
+        cls.buyer, cls.address = create_buyer('buyer')
+
+    def create_order(self, count, **flags):
+        order = Order.objects.create(store=self.store, user=self.buyer, address=self.address,
+                                     amount=self.product.cost * count, **flags)
+        OrderPosition.objects.create(order=order, product=self.product, count=count, cost=self.product.cost)
+        return order
+
+    def test_changes_are_rebuilt_by_the_worker(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_order(2, paid=True)
+            self.create_order(1, paid=True)
+            canceled = self.create_order(5, paid=True)
+            canceled.canceled = True
+            canceled.save(update_fields=['canceled'])
+        # заказы дня отмечают его один раз, статистику считает только обработчик
+        self.assertEqual(StaleSalesDay.objects.count(), 1)
+        self.assertFalse(StoreSalesDay.objects.exists())
+
+        self.assertEqual(rebuild_stale_sales(), (1, 0))
+        self.assertFalse(StaleSalesDay.objects.exists())
+        day = StoreSalesDay.objects.get()
+        self.assertEqual((day.date, day.orders, day.revenue, day.units, day.canceled_orders),
+                         (timezone.localdate(), 2, Decimal('300.00'), 3, 1))
+        product = ProductSalesDay.objects.get()
+        self.assertEqual((product.units, product.canceled_units), (3, 5))
+        self.assertEqual(rebuild_stale_sales(), (0, 0))
+
+    def test_command(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_order(1, paid=True)
+        out = io.StringIO()
+        call_command('process_sales_rollups', stdout=out)
+        self.assertIn('Пересчитано дней: 1, неудачных попыток: 0', out.getvalue())
+        self.assertEqual(StoreSalesDay.objects.get().orders, 1)
+
+    def test_uncommitted_changes_are_not_marked(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.create_order(1, paid=True)
+        self.assertEqual(len(callbacks), 2)
+        self.assertFalse(StaleSalesDay.objects.exists())
+
+
+class PaymentNotificationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seller = get_user_model().objects.create_user(username='seller', password='password')
+        buyer, address = create_buyer('buyer')
+        cls.order = Order.objects.create(store=create_store(seller), user=buyer, address=address, amount=100,
+                                         payment_id='payment-1')
+
+    @staticmethod
+    def notification(payment_id, status='succeeded', event=None):
+        return {'event': event or f'payment.{status}', 'object': {'id': payment_id, 'status': status}}
+
+    def test_repeated_success_notifies_once(self):
+        self.assertTrue(record_notification(self.notification('payment-1')))
+        self.assertTrue(record_notification(self.notification('payment-1')))
+        self.assertTrue(record_notification(self.notification('payment-1', event='payment.captured')))
+        self.assertEqual(process_payment_notifications(), (2, 0))
+
+        self.order.refresh_from_db()
+        self.assertTrue(self.order.paid)
+        self.assertEqual(PushNotification.objects.count(), 1)
+
+    def test_paid_order_is_sent_with_its_new_state(self):
+        channel_layer = get_channel_layer()
+        channel = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)(f'order-{self.order.id}', channel)
+        record_notification(self.notification('payment-1'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(process_payment_notifications(), (1, 0))
+
+        message = async_to_sync(channel_layer.receive)(channel)
+        self.assertEqual(json.loads(message['message'])['state'], Order.ASSEMBLING)
+        self.assertEqual(PushNotification.objects.get().data['order']['state'], Order.ASSEMBLING)
+
+    def test_failed_fan_out_keeps_the_order_unpaid(self):
+        record_notification(self.notification('payment-1'))
+        with mock.patch.object(notifications, 'enqueue_push', side_effect=RuntimeError('queue is down')):
+            self.assertEqual(process_payment_notifications(), (0, 1))
+        self.assertFalse(Order.objects.get(id=self.order.id).paid)
+        self.assertFalse(PushNotification.objects.exists())
+
+        PaymentNotification.objects.update(next_attempt_time=timezone.now())
+        self.assertEqual(process_payment_notifications(), (1, 0))
+        self.assertTrue(Order.objects.get(id=self.order.id).paid)
+        self.assertEqual(PushNotification.objects.count(), 1)
+
+    def test_notification_before_payment_is_saved_is_retried(self):
+        record_notification(self.notification('payment-2'))
+        self.assertEqual(process_payment_notifications(), (0, 1))
+        notification = PaymentNotification.objects.get()
+        self.assertIsNone(notification.processed_time)
+        self.assertEqual(notification.attempts, 1)
+
+        Order.objects.filter(id=self.order.id).update(payment_id='payment-2')
+        PaymentNotification.objects.update(next_attempt_time=timezone.now())
+        self.assertEqual(process_payment_notifications(), (1, 0))
+        self.assertTrue(Order.objects.get(id=self.order.id).paid)
+        self.assertEqual(PushNotification.objects.count(), 1)
+
+    def test_claimed_notifications_are_skipped(self):
+        record_notification(self.notification('payment-1'))
+        self.assertEqual(len(claim_notifications(10)), 1)
+        self.assertEqual(process_payment_notifications(), (0, 0))
+        self.assertFalse(Order.objects.get(id=self.order.id).paid)
+
+
+@override_settings(MARKETPLACE_PUSH_SENDER='fake')
+class PushQueueTests(TestCase):
+    def setUp(self):
+        FakePushSender.sent = list()
+        FakePushSender.fail = None
+        self.addCleanup(setattr, FakePushSender, 'fail', None)
+
+    def test_due_notifications_are_sent(self):
+        for topic in ('1', '2', '3'):
+            enqueue_push(topic, 'title', 'body')
+        metrics = process_push_queue()
+        self.assertEqual((metrics['sent'], metrics['retried'], metrics['dead']), (3, 0, 0))
+        self.assertEqual(sorted(push['topic'] for push in FakePushSender.sent), ['1', '2', '3'])
+        self.assertFalse(PushNotification.objects.exclude(status=PushNotification.SENT).exists())
+        self.assertEqual(process_push_queue()['sent'], 0)
+
+    def test_claimed_notifications_are_skipped(self):
+        enqueue_push('1', 'title', 'body')
+        self.assertEqual(len(claim_pushes(10)), 1)
+        self.assertEqual(process_push_queue()['sent'], 0)
+        self.assertEqual(FakePushSender.sent, [])
+
+    def test_failures_are_retried_with_backoff(self):
+        FakePushSender.fail = lambda notification: notification.topic == 'broken'
+        enqueue_push('broken', 'title', 'body')
+        enqueue_push('1', 'title', 'body')
+        for attempt in (1, 2, 3):
+            started = timezone.now()
+            metrics = process_push_queue()
+            self.assertEqual(metrics['retried'], 1)
+            notification = PushNotification.objects.get(topic='broken')
+            self.assertEqual((notification.status, notification.attempts), (PushNotification.PENDING, attempt))
+            self.assertIn('fake FCM failure', notification.last_error)
+            delay = (notification.next_attempt_time - started).total_seconds()
+            self.assertTrue(2 ** attempt <= delay < 2 ** attempt + 5, delay)
+            # до срока повтора уведомление не отправляется
+            self.assertEqual(process_push_queue()['retried'], 0)
+            PushNotification.objects.update(next_attempt_time=timezone.now())
+        self.assertEqual(len(FakePushSender.sent), 1)
+
+    def test_dead_letters(self):
+        FakePushSender.fail = lambda notification: True
+        notification = enqueue_push('1', 'title', 'body')
+        PushNotification.objects.update(attempts=PushNotification.MAX_ATTEMPTS - 1)
+        self.assertEqual(process_push_queue()['dead'], 1)
+        notification.refresh_from_db()
+        self.assertEqual((notification.status, notification.attempts),
+                         (PushNotification.DEAD, PushNotification.MAX_ATTEMPTS))
+        PushNotification.objects.update(next_attempt_time=timezone.now())
+        self.assertEqual(len(claim_pushes(10)), 0)
+
+        FakePushSender.fail = None
+        call_command('process_push_queue', requeue_dead=True, stdout=io.StringIO())
+        notification.refresh_from_db()
+        self.assertEqual((notification.status, notification.attempts), (PushNotification.SENT, 1))
+
+
+@override_settings(MARKETPLACE_PAYMENT_PROVIDER='fake')
+class PaymentOutboxTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seller = get_user_model().objects.create_user(username='seller', password='password')
+        buyer, address = create_buyer('buyer')
+        cls.order = Order.objects.create(store=create_store(seller), user=buyer, address=address, amount=100)
+
+    def setUp(self):
+        self.outbox = enqueue_payment(self.order)
+
+    def test_worker_creates_payment_once(self):
+        self.assertEqual(process_payment_outbox(), (1, 0))
+        self.assertEqual(process_payment_outbox(), (0, 0))
+        self.outbox.refresh_from_db()
+        self.assertEqual(self.outbox.status, PaymentOutbox.CREATED)
+        self.assertEqual(Order.objects.get(id=self.order.id).payment_id, self.outbox.payment_id)
+
+    def test_claimed_rows_are_skipped(self):
+        self.assertEqual(claim_payments(PaymentOutbox.objects.all(), 10), [self.outbox.id])
+        self.assertEqual(process_payment_outbox(), (0, 0))
+        self.assertNotIn(str(self.outbox.idempotency_key), FakePaymentProvider.payments)
+
+
+@override_settings(MARKETPLACE_PAYMENT_PROVIDER='fake')
+@skipUnlessDBFeature('test_db_allows_multiple_connections')
+class CheckoutTests(TransactionTestCase):
+    """Payments of a checkout are created in parallel threads, which need committed data."""
+
+    def test_checkout_of_several_stores(self):
+        seller = get_user_model().objects.create_user(username='seller', password='password')
+        stores = [create_store(seller, name=f'store {index}') for index in range(3)]
+        buyer, address = create_buyer('buyer')
+        for store in stores:
+            CartPosition.objects.create(user=buyer, product=create_product(store, store.name, '10.00'), count=2)
+        now = timezone.now()
+        Discount.objects.create(user=seller, product=Product.objects.get(store=stores[0]), discount_value=50,
+                                date_start=now - datetime.timedelta(days=1), date_end=now + datetime.timedelta(days=1))
+
+        response = call_action(OrderViewSet, 'checkout', buyer, data={'address': address.id})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(sorted(order['store'] for order in response.data), [store.id for store in stores])
+        self.assertEqual([order['payment']['status'] for order in response.data], [PaymentOutbox.CREATED] * 3)
+        self.assertEqual(Order.objects.filter(payment_id__isnull=False).count(), 3)
+        # на товар первого магазина действует скидка 50%
+        self.assertEqual(dict(Order.objects.values_list('store_id', 'amount')), {
+            stores[0].id: Decimal('10.00'), stores[1].id: Decimal('20.00'), stores[2].id: Decimal('20.00')
+        })
+        self.assertEqual(process_payment_outbox(), (0, 0))
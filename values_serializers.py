@@ -0,0 +1,152 @@
+from collections import OrderedDict
+
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.db.models import Exists, OuterRef
+from rest_framework import serializers
+
+from .models import Category
+from .models import ProductPhoto
+
+from .pricing import get_pricing
+
+from .serializers import StoreSerializer
+from .serializers import ProductSerializer
+from .serializers import photo_url
+
+
+class ValuesSerializer:
+    """
+    Renders rows fetched with QuerySet.values() into the same JSON as `serializer_class`, without building a model
+    instance and a set of serializer fields per row.
+
+    Field mappers are compiled once per serializer class and set of rendered fields (see SparseFieldsMixin).
+    Model columns, related primary keys, files and nested serializers are mapped automatically; values that are
+    not columns come from `annotations` (SQL expressions keyed by source path) or, for SerializerMethodField,
+    from `resolve_<field name>(rows)` methods that compute them for the whole page at once and return a dict
+    keyed by primary key. `resolver_keys` lists the columns those methods need.
+    """
+    serializer_class = None
+    annotations = {}
+    resolver_keys = {}
+    compiled = {}
+
+    def __init__(self, context):
+        self.context = context
+        fields = self.serializer_class(context=context).fields
+        key = (type(self), tuple(fields))
+        if key not in self.compiled:
+            self.compiled[key] = self.compile(fields)
+        self.keys, self.aliases, self.mappers, self.method_fields = self.compiled[key]
+
+    def compile(self, fields):
+        model = self.serializer_class.Meta.model
+        keys = {model._meta.pk.attname}
+        aliases = dict()
+        method_fields = list()
+        mappers = list()
+        for name, field in fields.items():
+            if isinstance(field, serializers.SerializerMethodField):
+                if not hasattr(self, f'resolve_{name}'):
+                    raise ImproperlyConfigured(f'{type(self).__name__} should define resolve_{name}(rows)')
+                method_fields.append(name)
+                keys.update(self.resolver_keys.get(name, ()))
+                mappers.append((name, self.method_mapper(name, model._meta.pk.attname)))
+            else:
+                mappers.append((name, self.field_mapper(field, model, '', keys, aliases)))
+        return keys, aliases, mappers, method_fields
+
+    def field_mapper(self, field, model, prefix, keys, aliases):
+        path = prefix + field.source
+        if isinstance(field, serializers.BaseSerializer):
+            if getattr(field, 'many', False):
+                raise ImproperlyConfigured(f'{path}: many=True serializers are not supported')
+            related_model = model._meta.get_field(field.source).related_model
+            pk_key = f'{path}__{related_model._meta.pk.attname}'
+            keys.add(pk_key)
+            nested = [(name, self.field_mapper(nested_field, related_model, f'{path}__', keys, aliases))
+                      for name, nested_field in field.fields.items()]
+
+            def nested_mapper(row, resolved, request):
+                if row[pk_key] is None:
+                    return None
+                return OrderedDict((name, mapper(row, resolved, request)) for name, mapper in nested)
+            return nested_mapper
+
+        if path in self.annotations:
+            key = 'annotation_' + path.replace('__', '_')
+            aliases[key] = self.annotations[path]
+        else:
+            try:
+                model._meta.get_field(field.source)
+            except FieldDoesNotExist:
+                raise ImproperlyConfigured(f'{path} is not a column, add it to {type(self).__name__}.annotations')
+            key = path
+        keys.add(key)
+
+        if isinstance(field, serializers.FileField):
+            model_field = model._meta.get_field(field.source)
+
+            def file_mapper(row, resolved, request):
+                if not row[key]:
+                    return None
+                url = model_field.storage.url(row[key])
+                return request.build_absolute_uri(url) if request is not None else url
+            return file_mapper
+
+        if isinstance(field, serializers.RelatedField):
+            return lambda row, resolved, request: row[key]
+
+        to_representation = field.to_representation
+
+        def value_mapper(row, resolved, request):
+            value = row[key]
+            return None if value is None else to_representation(value)
+        return value_mapper
+
+    @staticmethod
+    def method_mapper(name, pk_key):
+        return lambda row, resolved, request: resolved[name][row[pk_key]]
+
+    def get_queryset(self, queryset):
+        # аннотации исходного queryset (например, релевантность поиска) сохраняются для сортировки
+        queryset = queryset.prefetch_related(None).select_related(None)
+        if self.aliases:
+            queryset = queryset.annotate(**self.aliases)
+        return queryset.values(*self.keys, *queryset.query.annotations)
+
+    def to_representation(self, rows):
+        rows = list(rows)
+        request = self.context.get('request')
+        resolved = {name: getattr(self, f'resolve_{name}')(rows) for name in self.method_fields}
+        return [
+            OrderedDict((name, mapper(row, resolved, request)) for name, mapper in self.mappers)
+            for row in rows
+        ]
+
+
+class StoreValuesSerializer(ValuesSerializer):
+    serializer_class = StoreSerializer
+
+
+class ProductValuesSerializer(ValuesSerializer):
+    serializer_class = ProductSerializer
+    annotations = {
+        'category__nested': Exists(Category.objects.filter(category=OuterRef('category'))),
+    }
+    resolver_keys = {
+        'cost_with_discount': ['cost'],
+    }
+
+    def resolve_photos(self, rows):
+        request = self.context['request']
+        storage = ProductPhoto._meta.get_field('img').storage
+        photos = {row['id']: list() for row in rows}
+        for product_id, img in ProductPhoto.objects.filter(product_id__in=photos).order_by('id').values_list(
+                'product_id', 'img'):
+            photos[product_id].append(photo_url(request, storage.url(img)))
+        return photos
+
+    def resolve_cost_with_discount(self, rows):
+        pricing = get_pricing(self.context)
+        pricing.load_ids(row['id'] for row in rows)
+        return {row['id']: pricing.cost_for(row['id'], row['cost']) for row in rows}
@@ -1,3 +1,6 @@
+import datetime
+from decimal import Decimal
+
 import pandas as pd
 import requests
 
@@ -7,12 +10,12 @@ from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.filters import SearchFilter, OrderingFilter
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.utils import json, encoders
 
-from django.db.models import Sum, F
+from django.db.models import Sum, Max, Count, Prefetch, prefetch_related_objects
 from django.db import transaction
 from django.conf import settings
 from django.core.files.base import ContentFile
+from django.utils import timezone
 
 from .models import Store
 from .models import StoreContact
@@ -31,11 +34,14 @@ from .models import BundlePosition
 from .models import BundlePhoto
 from .models import Discount
 from .models import DeliveryCost
+from .models import StoreSalesDay
+from .models import ProductSalesDay
 
 from .serializers import StoreSerializer
 from .serializers import StoreContactSerializer
 from .serializers import CategorySerializer
 from .serializers import ProductSerializer
+from .serializers import ProductDetailSerializer
 from .serializers import ProductGroupSerializer
 from .serializers import ProductPhotoSerializer
 from .serializers import ProductPropertySerializer
@@ -51,30 +57,56 @@ from .serializers import BundleSerializer
 from .serializers import BundlePositionSerializer
 from .serializers import BundlePhotoSerializer
 from .serializers import DeliveryCostSerializer
+from .serializers import StoreSalesSerializer
+from .serializers import ProductSalesSerializer
+
+from .values_serializers import StoreValuesSerializer
+from .values_serializers import ProductValuesSerializer
 
 from .pagination import StandardPagination
+from .pagination import KeysetOptionalPagination
 
-from .filters import query_params_filter
+from .mixins import EagerLoadingMixin
+from .mixins import ResponseCacheMixin
+from .mixins import ConditionalGetMixin
+from .mixins import ValuesListMixin
+from .mixins import FacetsMixin
 
-from yookassa import Configuration, Payment, Refund
+from .caching import touch
 
-from pyfcm import FCMNotification
+from .carts import get_cart_storage
 
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from .payments import create_payments
+from .payments import enqueue_payment
+from .payments import enqueue_payments
+from .payments import get_payment_provider
+from .payments import payment_state
+from .payments import record_notification
 
-channel_layer = get_channel_layer()
-push_service = FCMNotification(api_key=settings.FCM_DJANGO_SETTINGS["FCM_SERVER_KEY"])
+from .notifications import send_new_orders
+
+from .pricing import DiscountPricing
+from .pricing import get_pricing
+
+from .filters import query_params_filter
+from .filters import query_params_range_filter
+from .filters import property_filter
+from .filters import ProductSearchFilter
+from .filters import category_subtree_filter
+
+from yookassa import Configuration, Refund
 
 Configuration.account_id = settings.YOOKASSA_MARKETPLACE["account_id"]
 Configuration.secret_key = settings.YOOKASSA_MARKETPLACE["secret_key"]
 
 
-class StoreViewSet(ReadOnlyModelViewSet):
+class StoreViewSet(ResponseCacheMixin, ValuesListMixin, ReadOnlyModelViewSet):
     queryset = Store.objects.filter(moderator_confirmed=True, blocked=False)
     serializer_class = StoreSerializer
+    values_serializer_class = StoreValuesSerializer
     pagination_class = StandardPagination
     permission_classes = [AllowAny]
+    cache_models = [Store, City]
     filter_backends = [SearchFilter, OrderingFilter]
     filter_key_fields = ['city']
     filter_char_fields = ['name']
@@ -86,11 +118,12 @@ class StoreViewSet(ReadOnlyModelViewSet):
         return super(StoreViewSet, self).filter_queryset(queryset)
 
 
-class StoreContactViewSet(ReadOnlyModelViewSet):
+class StoreContactViewSet(ResponseCacheMixin, ReadOnlyModelViewSet):
     queryset = StoreContact.objects.filter(store__moderator_confirmed=True, store__blocked=False)
     serializer_class = StoreContactSerializer
     pagination_class = StandardPagination
     permission_classes = [AllowAny]
+    cache_models = [StoreContact, Store]
     filter_backends = [SearchFilter, OrderingFilter]
     filter_key_fields = ['store']
     filter_char_fields = ['contact_name', 'contact_data']
@@ -102,11 +135,12 @@ class StoreContactViewSet(ReadOnlyModelViewSet):
         return super(StoreContactViewSet, self).filter_queryset(queryset)
 
 
-class CategoryViewSet(ReadOnlyModelViewSet):
+class CategoryViewSet(ConditionalGetMixin, ResponseCacheMixin, EagerLoadingMixin, ReadOnlyModelViewSet):
     queryset = Category.objects.filter(moderator_confirmed=True)
     serializer_class = CategorySerializer
     pagination_class = StandardPagination
     permission_classes = [AllowAny]
+    cache_models = [Category]
     filter_backends = [SearchFilter, OrderingFilter]
     filter_key_fields = ['category']
     filter_char_fields = ['name']
@@ -117,34 +151,79 @@ class CategoryViewSet(ReadOnlyModelViewSet):
         queryset = query_params_filter(self.request, queryset, self.filter_key_fields, self.filter_char_fields)
         return super(CategoryViewSet, self).filter_queryset(queryset)
 
-
-class ProductViewSet(ReadOnlyModelViewSet):
-    queryset = Product.objects.filter(category__moderator_confirmed=True,
-                                      store__moderator_confirmed=True,
-                                      store__blocked=False,
-                                      blocked=False)
+    @action(methods=['get'], detail=False)
+    def tree(self, request):
+        return self.get_conditional_response(self.get_cached_tree, request)
+
+    def get_cached_tree(self, request):
+        return self.get_cached_response(self.get_tree, request)
+
+    def get_tree(self, request):
+        categories = list(CategorySerializer.setup_eager_loading(self.get_queryset()).order_by('path'))
+        nodes = dict()
+        roots = list()
+        # родитель всегда идет раньше своих подкатегорий, так как его путь - префикс их путей
+        for category, data in zip(categories, self.get_serializer(categories, many=True).data):
+            data['children'] = list()
+            nodes[category.id] = data
+            if category.category_id is None:
+                roots.append(data)
+            elif category.category_id in nodes:
+                nodes[category.category_id]['children'].append(data)
+        return Response(roots)
+
+
+class ProductViewSet(ConditionalGetMixin, ResponseCacheMixin, FacetsMixin, ValuesListMixin, EagerLoadingMixin,
+                     ReadOnlyModelViewSet):
+    queryset = Product.objects.visible()
     serializer_class = ProductSerializer
-    pagination_class = StandardPagination
+    values_serializer_class = ProductValuesSerializer
+    pagination_class = KeysetOptionalPagination
     permission_classes = [AllowAny]
-    filter_backends = [SearchFilter, OrderingFilter]
+    cache_models = [Product, Store, Category, Discount, ProductPhoto, ProductProperty]
+    filter_backends = [ProductSearchFilter, OrderingFilter]
     filter_key_fields = ['category', 'store', 'group']
     filter_char_fields = ['name']
-    search_fields = ['name', 'description']
-    ordering_fields = ['name', 'description', 'cost']
+    filter_range_fields = {'cost': 'effective_cost'}
+    ordering_fields = ['name', 'description', 'cost', 'effective_cost']
 
     def filter_queryset(self, queryset):
         queryset = query_params_filter(self.request, queryset, self.filter_key_fields, self.filter_char_fields)
+        queryset = query_params_range_filter(self.request, queryset, self.filter_range_fields)
+        queryset = category_subtree_filter(self.request, queryset, 'category_tree')
+        queryset = property_filter(self.request, queryset)
         return super(ProductViewSet, self).filter_queryset(queryset)
 
-
-class ProductPhotoViewSet(ReadOnlyModelViewSet):
-    queryset = ProductPhoto.objects.filter(product__category__moderator_confirmed=True,
-                                           product__store__moderator_confirmed=True,
-                                           product__store__blocked=False,
-                                           product__blocked=False)
+    @action(methods=['get'], detail=True, serializer_class=ProductDetailSerializer, cache_models=[
+        Product, Store, StoreContact, Category, Discount, ProductPhoto, ProductProperty, DeliveryCost
+    ])
+    def details(self, request, pk=None):
+        """
+        Product card in one request: ?city=<id> adds the delivery cost of the store to that city.
+        """
+        return self.get_conditional_response(self.get_cached_details, request, pk=pk)
+
+    def get_cached_details(self, request, pk=None):
+        return self.get_cached_response(self.get_details, request, pk=pk)
+
+    def get_details(self, request, pk=None):
+        city_id = request.query_params.get('city')
+        if city_id is not None and not city_id.isdigit():
+            return Response({'detail': 'Идентификатор города должен представлять целое число'}, status=400)
+        fields = set(self.get_serializer().fields)
+        queryset = ProductDetailSerializer.setup_eager_loading(self.get_queryset(), fields, city_id)
+        product = queryset.filter(pk=pk).first() if str(pk).isdigit() else None
+        if product is None:
+            return Response({'detail': 'Товар не существует'}, status=404)
+        return Response(self.get_serializer(product).data)
+
+
+class ProductPhotoViewSet(ResponseCacheMixin, ReadOnlyModelViewSet):
+    queryset = ProductPhoto.objects.filter(product__is_visible=True)
     serializer_class = ProductPhotoSerializer
     pagination_class = StandardPagination
     permission_classes = [AllowAny]
+    cache_models = [ProductPhoto, Product, Store, Category]
     filter_backends = [SearchFilter, OrderingFilter]
     filter_key_fields = ['product']
     filter_char_fields = []
@@ -156,14 +235,12 @@ class ProductPhotoViewSet(ReadOnlyModelViewSet):
         return super(ProductPhotoViewSet, self).filter_queryset(queryset)
 
 
-class ProductPropertyViewSet(ReadOnlyModelViewSet):
-    queryset = ProductProperty.objects.filter(product__category__moderator_confirmed=True,
-                                              product__store__moderator_confirmed=True,
-                                              product__store__blocked=False,
-                                              product__blocked=False)
+class ProductPropertyViewSet(ResponseCacheMixin, ReadOnlyModelViewSet):
+    queryset = ProductProperty.objects.filter(product__is_visible=True)
     serializer_class = ProductPropertySerializer
     pagination_class = StandardPagination
     permission_classes = [AllowAny]
+    cache_models = [ProductProperty, Product, Store, Category]
     filter_backends = [SearchFilter, OrderingFilter]
     filter_key_fields = ['product']
     filter_char_fields = []
@@ -175,7 +252,7 @@ class ProductPropertyViewSet(ReadOnlyModelViewSet):
         return super(ProductPropertyViewSet, self).filter_queryset(queryset)
 
 
-class CartPositionViewSet(ReadOnlyModelViewSet):
+class CartPositionViewSet(EagerLoadingMixin, ReadOnlyModelViewSet):
     queryset = CartPosition.objects.all()
     serializer_class = CartPositionSerializer
     pagination_class = StandardPagination
@@ -197,11 +274,49 @@ class CartPositionViewSet(ReadOnlyModelViewSet):
         queryset = query_params_filter(self.request, queryset, self.filter_key_fields, self.filter_char_fields)
         return super(CartPositionViewSet, self).filter_queryset(queryset)
 
+    def get_stored_positions(self):
+        """
+        Unsaved positions of the anonymous ?tmp= cart if it is kept outside of CartPosition (see carts.py),
+        filtered by ?product= and ?search= like the queryset; None for carts stored as CartPosition rows.
+        """
+        tmp_user_code = self.request.query_params.get('tmp')
+        storage = get_cart_storage()
+        if not tmp_user_code or storage.database:
+            return None
+        counts = storage.get(tmp_user_code)
+        products = ProductSerializer.setup_eager_loading(Product.objects.filter(id__in=counts)).in_bulk()
+        product_ids = self.request.query_params.getlist('product')
+        terms = [term.lower() for term in SearchFilter().get_search_terms(self.request)]
+        return [
+            CartPosition(tmp_user_code=tmp_user_code, product=products[product_id], count=count)
+            for product_id, count in sorted(counts.items())
+            if product_id in products and (not product_ids or str(product_id) in product_ids)
+            and all(term in products[product_id].name.lower() for term in terms)
+        ]
+
+    def get_positions(self):
+        positions = self.get_stored_positions()
+        if positions is None:
+            queryset = CartPositionSerializer.setup_eager_loading(self.filter_queryset(self.get_queryset()))
+            positions = list(queryset.order_by('id'))
+        return positions
+
+    def list(self, request, *args, **kwargs):
+        positions = self.get_stored_positions()
+        if positions is None:
+            return super(CartPositionViewSet, self).list(request, *args, **kwargs)
+        page = self.paginate_queryset(positions)
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
     @action(methods=["post"], detail=False)
     def sync(self, request):
         if request.user.is_authenticated:
-            CartPosition.objects.filter(tmp_user_code=request.data.get("tmp")).update(user=request.user)
-            return Response({"detail": "Synchronized successfully"}, status=200)
+            get_cart_storage().persist(request.data.get("tmp"), request.user)
+            positions = CartPositionSerializer.setup_eager_loading(request.user.cartposition_set.order_by('id'))
+            return Response({
+                "detail": "Synchronized successfully",
+                "cart_positions": self.get_serializer(positions, many=True).data
+            }, status=200)
         return Response({"detail": "Unauthorized user"}, status=403)
 
     @action(methods=["post"], detail=False)
@@ -212,9 +327,23 @@ class CartPositionViewSet(ReadOnlyModelViewSet):
         if not Product.objects.filter(id=product_id).exists():
             return Response({"detail": "Товар не существует"}, status=400)
 
+        storage = get_cart_storage()
+        tmp_user_code = self.request.query_params.get("tmp")
+        if tmp_user_code and not storage.database:
+            product_id = int(product_id)
+            in_cart = product_id in storage.get(tmp_user_code)
+            if not in_cart and count <= 0:
+                return Response({"detail": 'Невозможно добавить 0 и меньше товаров в корзину'}, status=400)
+            storage.apply_counts(tmp_user_code, {product_id: count})
+            if not in_cart:
+                return Response({'detail': 'Товар успешно добавлен в корзину'})
+            if count > 0:
+                return Response({'detail': 'зиция корзины успешно изменена'})
+            return Response({'detail': 'Товар успешно удален из корзины'})
+
         if self.get_queryset().filter(product_id=product_id).exists():
             if count >= 0:
-                self.get_queryset().filter(product_id=product_id).update(count=count)
+                self.get_queryset().filter(product_id=product_id).update(count=count, updated_time=timezone.now())
                 return Response({'detail': 'зиция корзины успешно изменена'})
             else:
                 self.get_queryset().filter(product_id=product_id).delete()
@@ -228,39 +357,103 @@ class CartPositionViewSet(ReadOnlyModelViewSet):
                 self.queryset.create(product_id=product_id, count=count, tmp_user_code=self.request.query_params.get("tmp"))
                 return Response({'detail': 'Товар успешно добавлен в корзину'})
 
+    @transaction.atomic
+    @action(methods=['post'], detail=False)
+    def batch(self, request):
+        """
+        Applies a list of {"product": id, "count": n} changes to the cart at once (count 0 removes the product,
+        the last change of a product wins) and returns the new cart.
+        """
+        changes = request.data.get('positions') if isinstance(request.data, dict) else request.data
+        if not isinstance(changes, list) or not all(isinstance(change, dict) for change in changes):
+            return Response({'detail': 'Передайте список изменений корзины'}, status=400)
+        counts = dict()
+        for change in changes:
+            product_id, count = change.get('product'), change.get('count')
+            if not isinstance(product_id, int) or isinstance(product_id, bool):
+                return Response({'detail': 'Идентификатор товара должен представлять целое число'}, status=400)
+            if not isinstance(count, int) or isinstance(count, bool) or count < 0:
+                return Response({'detail': 'Количество товара должно быть неотрицательным целым числом'}, status=400)
+            counts[product_id] = count
+
+        added = {product_id for product_id, count in counts.items() if count > 0}
+        missing = added - set(Product.objects.filter(id__in=added).values_list('id', flat=True))
+        if missing:
+            return Response({'detail': 'Товар не существует', 'products': sorted(missing)}, status=400)
+
+        tmp_user_code = request.query_params.get('tmp')
+        if tmp_user_code:
+            get_cart_storage().apply_counts(tmp_user_code, counts)
+        elif request.user.is_authenticated:
+            self.get_queryset().apply_counts(counts, user=request.user)
+        else:
+            return Response({'detail': 'Укажите временный токен пользователя'}, status=400)
+        return Response(self.get_serializer(self.get_positions(), many=True).data)
+
     @action(methods=["get"], detail=False)
     def amount(self, request):
-        queryset = self.filter_queryset(self.get_queryset())
-        amount = queryset.aggregate(amount=Sum(F('product__cost') * F('count')))['amount']
+        positions = self.get_stored_positions()
+        if positions is None:
+            positions = self.filter_queryset(self.get_queryset()).select_related('product')
+        amount = DiscountPricing().amount(positions)
         return Response({'amount': round(amount, 2)})
 
     @action(methods=['get'], detail=False)
     def is_many_stores(self, request):
-        return Response({'many': self.get_queryset().values('product__shop').distinct().count() > 1})
+        positions = self.get_stored_positions()
+        if positions is not None:
+            return Response({'many': len({position.product.store_id for position in positions}) > 1})
+        return Response({'many': self.get_queryset().values('product__store').distinct().count() > 1})
 
     @action(methods=['get'], detail=False)
     def by_stores(self, request):
+        """
+        Cart positions grouped by store with subtotals: goods amount with discounts, delivery cost to ?city=<id>
+        (null if the store does not deliver there or no city is passed) and their total.
+        """
+        city_id = request.query_params.get('city')
+        if city_id is not None and not city_id.isdigit():
+            return Response({'detail': 'Идентификатор города должен представлять целое число'}, status=400)
+        positions = self.get_positions()
+        if city_id is not None:
+            prefetch_related_objects(positions, Prefetch(
+                'product__store__delivery_costs', queryset=DeliveryCost.objects.filter(city_id=city_id),
+                to_attr='city_delivery_costs'
+            ))
+
+        # одна сериализация и одна загрузка скидок на всю корзину, группировка по магазинам в памяти
+        context = self.get_serializer_context()
+        pricing = get_pricing(context)
+        data = self.get_serializer_class()(positions, many=True, context=context).data
+        stores = dict()
+        for position, position_data in zip(positions, data):
+            store = position.product.store
+            if store.id not in stores:
+                stores[store.id] = {'store': store, 'cart_positions': list(), 'amount': Decimal(0)}
+            stores[store.id]['cart_positions'].append(position_data)
+            stores[store.id]['amount'] += pricing.effective_cost(position.product) * position.count
+
         resp = list()
-        queryset = self.filter_queryset(self.get_queryset())
-        store_names = queryset.values_list('product__store__name', flat=True).distinct()
-        store_id_list = queryset.values_list('product__store_id', flat=True).distinct()
-        for name, identifier in zip(store_names, store_id_list):
-            positions = queryset.filter(product__shop__name=name)
-            amount = positions.aggregate(amount=Sum(F('product__cost') * F('count')))['amount']
+        for group in sorted(stores.values(), key=lambda group: group['store'].name):
+            delivery_costs = getattr(group['store'], 'city_delivery_costs', None)
+            delivery_cost = delivery_costs[0].apply(group['amount']) if delivery_costs else None
             resp.append({
-                'store_name': name,
-                'store_id': identifier,
-                'cart_positions': self.get_serializer(positions, many=True).data,
-                'amount': round(amount, 2)
+                'store_name': group['store'].name,
+                'store_id': group['store'].id,
+                'cart_positions': group['cart_positions'],
+                'amount': round(group['amount'], 2),
+                'delivery_cost': delivery_cost,
+                'total': round(group['amount'] + (delivery_cost or 0), 2),
             })
         return Response(resp)
 
 
-class CityViewSet(ReadOnlyModelViewSet):
+class CityViewSet(ResponseCacheMixin, ReadOnlyModelViewSet):
     queryset = City.objects.all()
     serializer_class = CitySerializer
     pagination_class = StandardPagination
     permission_classes = [AllowAny]
+    cache_models = [City]
     filter_backends = [SearchFilter, OrderingFilter]
     filter_key_fields = []
     filter_char_fields = ['name']
@@ -291,18 +484,20 @@ class OrderAddressViewSet(ModelViewSet):
         return super(OrderAddressViewSet, self).filter_queryset(queryset)
 
 
-class OrderViewSet(ReadOnlyModelViewSet):
+class OrderViewSet(ConditionalGetMixin, EagerLoadingMixin, ReadOnlyModelViewSet):
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
-    pagination_class = StandardPagination
+    pagination_class = KeysetOptionalPagination
     filter_backends = [SearchFilter, OrderingFilter]
-    filter_key_fields = ['address', 'paid', 'completed', 'delivered']
+    filter_key_fields = ['address', 'paid', 'completed', 'delivered', 'state']
     filter_char_fields = []
     search_fields = ['address__address']
-    ordering_fields = ['amount']
+    ordering_fields = ['amount', 'created_time', 'state']
+    cache_models = [Store, OrderAddress]
     actions_permission_classes = {
         'default': [AllowAny],
         'create': [IsAuthenticated],
+        'checkout': [IsAuthenticated],
         'pay': [IsAuthenticated],
         'pay_notifications': [AllowAny],
     }
@@ -319,6 +514,17 @@ class OrderViewSet(ReadOnlyModelViewSet):
         queryset = query_params_filter(self.request, queryset, self.filter_key_fields, self.filter_char_fields)
         return super(OrderViewSet, self).filter_queryset(queryset)
 
+    def get_version_stamps(self, request):
+        queryset = self.get_queryset()
+        if self.action == 'retrieve':
+            queryset = queryset.filter(pk=self.kwargs[self.lookup_field])
+        # количество заказов учитывается, чтобы ETag менялся и при удалении заказов
+        stamp = queryset.aggregate(updated_time=Max('updated_time'), count=Count('id'))
+        versions, last_modified = super(OrderViewSet, self).get_version_stamps(request)
+        if stamp['updated_time']:
+            last_modified = max(last_modified or 0, int(stamp['updated_time'].timestamp()) * 10 ** 9)
+        return [request.user.id, stamp['count'], str(stamp['updated_time']), versions], last_modified
+
     @transaction.atomic
     @action(methods=['post'], detail=False)
     def create_order(self, request):
@@ -335,107 +541,121 @@ class OrderViewSet(ReadOnlyModelViewSet):
             return Response({'detail': 'Неверный идентификатор адреса'}, status=400)
 
         cart_positions = request.user.cartposition_set.filter(product__store_id=store_id)
-        amount = round(cart_positions.aggregate(amount=Sum(F('product__cost') * F('count')))['amount'], 2)
-        payment = Payment.create({
-            "amount": {
-                "value": str(amount),
-                "currency": 'RUB'
-            },
-            "confirmation": {
-                "type": "redirect",
-                "return_url": settings.YOOKASSA_MARKETPLACE["confirmation_redirect_url"]
-            },
-            "capture": True,
-            "description": f"Заказ USER:{request.user.id} {str(amount)}RUB"
-        })
-        order = Order.objects.create(
-            store_id=store_id, address_id=address_id, user=request.user, amount=amount, payment_id=payment.id
-        )
-        for cart_position in cart_positions:
-            order.orderposition_set.create(product=cart_position.product, count=cart_position.count)
-        serializer = self.get_serializer(order)
-        order_data = serializer.data
-        order_text_data = json.dumps(order_data, cls=encoders.JSONEncoder, ensure_ascii=False)
-        async_to_sync(channel_layer.group_send)(
-            f"order-admin-{order.store.user_id}", {"type": "new_order", "message": order_text_data}
-        )
-        return Response(order_data, status=201)
+        rows = list(cart_positions.values_list('product_id', 'product__cost', 'count'))
+        # цены со скидками, как в CartPositionViewSet.amount и by_stores
+        pricing = DiscountPricing()
+        pricing.load_ids(product_id for product_id, cost, count in rows)
+        counts = dict()
+        costs = dict()
+        for product_id, cost, count in rows:
+            counts[product_id] = counts.get(product_id, 0) + count
+            costs[product_id] = pricing.effective_cost_for(product_id, cost)
+        short = Product.objects.reserve(counts)
+        if short:
+            return Response({'detail': 'Недостаточно товара в наличии', 'products': short}, status=400)
+        transaction.on_commit(lambda: touch(Product))
+
+        amount = round(sum((costs[product_id] * count for product_id, count in counts.items()), Decimal(0)), 2)
+        order = Order.objects.create(store_id=store_id, address_id=address_id, user=request.user, amount=amount)
+        OrderPosition.objects.bulk_create([
+            OrderPosition(order=order, product_id=product_id, count=count, cost=costs[product_id])
+            for product_id, count in counts.items()
+        ])
+        # платеж создает process_payment_outbox после фиксации транзакции
+        outbox = enqueue_payment(order)
+        transaction.on_commit(lambda: send_new_orders([order]))
+        return Response(dict(self.get_serializer(order).data, payment=payment_state(outbox)), status=201)
+
+    @action(methods=['post'], detail=False)
+    def checkout(self, request):
+        """
+        Orders the whole cart, or its `stores` part, in one call: an order per store, all created in one
+        transaction. The payments of the orders are created in parallel after the commit.
+        """
+        address_id = request.data.get('address')
+        store_ids = request.data.get('stores')
+
+        if not isinstance(address_id, int):
+            return Response({'detail': 'Идентификатор адреса должен представлять целое число'}, status=400)
+        if store_ids is not None and (
+            not isinstance(store_ids, list) or not all(isinstance(store_id, int) for store_id in store_ids)
+        ):
+            return Response({'detail': 'Магазины должны быть заданы списком целых чисел'}, status=400)
+        if not request.user.orderaddress_set.filter(id=address_id).exists():
+            return Response({'detail': 'Неверный идентификатор адреса'}, status=400)
+
+        cart_positions = request.user.cartposition_set.filter(product__store__isnull=False)
+        if store_ids is not None:
+            cart_positions = cart_positions.filter(product__store_id__in=store_ids)
+
+        with transaction.atomic():
+            rows = list(cart_positions.values_list('product__store_id', 'product_id', 'product__cost', 'count'))
+            # цены со скидками, как в CartPositionViewSet.amount и by_stores
+            pricing = DiscountPricing()
+            pricing.load_ids(product_id for store_id, product_id, cost, count in rows)
+            counts = dict()
+            costs = dict()
+            carts = dict()
+            for store_id, product_id, cost, count in rows:
+                counts[product_id] = counts.get(product_id, 0) + count
+                costs[product_id] = pricing.effective_cost_for(product_id, cost)
+                cart = carts.setdefault(store_id, {'amount': Decimal(0), 'counts': dict()})
+                cart['amount'] += costs[product_id] * count
+                cart['counts'][product_id] = cart['counts'].get(product_id, 0) + count
+            if not carts:
+                return Response({'detail': 'В вашей корзине нет товаров'}, status=400)
+            short = Product.objects.reserve(counts)
+            if short:
+                return Response({'detail': 'Недостаточно товара в наличии', 'products': short}, status=400)
+            transaction.on_commit(lambda: touch(Product))
+
+            stores = Store.objects.in_bulk(list(carts))
+            orders = Order.objects.create_all([
+                Order(store=stores[store_id], address_id=address_id, user=request.user, amount=round(cart['amount'], 2))
+                for store_id, cart in carts.items()
+            ])
+            OrderPosition.objects.bulk_create([
+                OrderPosition(order=order, product_id=product_id, count=count, cost=costs[product_id])
+                for order in orders for product_id, count in carts[order.store_id]['counts'].items()
+            ])
+            outboxes = enqueue_payments(orders)
+            transaction.on_commit(lambda: send_new_orders(orders))
+
+        # неудавшиеся платежи повторит process_payment_outbox
+        create_payments(outboxes)
+        data = self.get_serializer(orders, many=True).data
+        return Response([
+            dict(order_data, payment=payment_state(outbox)) for order_data, outbox in zip(data, outboxes)
+        ], status=201)
 
-    @transaction.atomic
     @action(methods=['post'], detail=True)
     def pay(self, request, pk):
         instance = self.get_object()
         if instance.canceled:
             return Response({'detail': 'Заказ был отменен'}, status=400)
         if instance.payment_id:
-            payment = Payment.find_one(instance.payment_id)
-        else:
-            payment = Payment.create({
-                "amount": {
-                    "value": str(instance.amount),
-                    "currency": 'RUB'
-                },
-                "confirmation": {
-                    "type": "redirect",
-                    "return_url": settings.YOOKASSA_MARKETPLACE["confirmation_redirect_url"]
-                },
-                "capture": True,
-                "description": f"Заказ USER:{instance.user_id} {str(instance.amount)}RUB"
-            })
-            instance.payment_id = payment.id
-            instance.save()
-        return Response(payment.json())
+            return Response(get_payment_provider().find(instance.payment_id))
+        return Response(payment_state(enqueue_payment(instance)), status=202)
+
+    @action(methods=['get'], detail=True)
+    def payment(self, request, pk):
+        """
+        State of the order payment. After checkout the client polls it until confirmation_url appears.
+        """
+        return Response(payment_state(self.get_object().payment_outbox.order_by('-id').first()))
 
     @action(methods=['post'], detail=False)
     def pay_notifications(self, request):
-        payment = request.data.get("object")
-        instance = Order.objects.get(payment_id=payment['id'])
-        if payment["status"] == "succeeded":
-            instance.paid = True
-            instance.save()
-            instance_data = self.get_serializer(instance).data
-            instance_text_data = json.dumps(instance_data, cls=encoders.JSONEncoder, ensure_ascii=False)
-            async_to_sync(channel_layer.group_send)(
-                f"order-{instance.id}", {"type": "order_change", "message": instance_text_data}
-            )
-            async_to_sync(channel_layer.group_send)(
-                f"order-admin-{instance.id}", {"type": "order_paid", "message": instance_text_data}
-            )
-            extra_notification_kwargs = {
-                "push_type": "order_change",
-                "order_id": instance.id,
-                "order": instance_data
-            }
-            push_service.notify_topic_subscribers(
-                message_title=f"Заказ #{instance.id} оплачен",
-                badge=1,
-                topic_name=str(instance.user_id),
-                message_body="Заказ успешно оплачен! Продавец уже начал его собирать.",
-                sound="default",
-                extra_notification_kwargs=extra_notification_kwargs
-            )
-        else:
-            payment = Payment.create({
-                "amount": {
-                    "value": str(instance.amount),
-                    "currency": 'RUB'
-                },
-                "confirmation": {
-                    "type": "redirect",
-                    "return_url": settings.YOOKASSA_MARKETPLACE["confirmation_redirect_url"]
-                },
-                "capture": True,
-                "description": f"Заказ USER:{instance.user_id} {str(instance.amount)}RUB"
-            })
-            instance.payment_id = payment.id
-            instance.save()
+        # уведомление только сохраняется, обрабатывает его process_payment_notifications
+        if not record_notification(request.data):
+            return Response({'detail': 'Неверное уведомление'}, status=400)
         return Response(status=200)
 
 
 class OrderPositionViewSet(ReadOnlyModelViewSet):
     queryset = OrderPosition.objects.all()
     serializer_class = OrderPositionSerializer
-    pagination_class = StandardPagination
+    pagination_class = KeysetOptionalPagination
     permission_classes = [IsAuthenticated]
     filter_backends = [SearchFilter, OrderingFilter]
     filter_key_fields = ['order', 'product']
@@ -451,16 +671,16 @@ class OrderPositionViewSet(ReadOnlyModelViewSet):
         return super(OrderPositionViewSet, self).filter_queryset(queryset)
 
 
-class OrderAdminViewSet(GenericViewSet):
+class OrderAdminViewSet(EagerLoadingMixin, GenericViewSet):
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
-    pagination_class = StandardPagination
+    pagination_class = KeysetOptionalPagination
     permission_classes = [IsAuthenticated]
     filter_backends = [SearchFilter, OrderingFilter]
-    filter_key_fields = ['store', 'user', 'paid', 'completed', 'delivered']
+    filter_key_fields = ['store', 'user', 'paid', 'completed', 'delivered', 'state']
     filter_char_fields = ['store__name']
     search_fields = ['store__name']
-    ordering_fields = ['store__name']
+    ordering_fields = ['store__name', 'created_time', 'state']
 
     def get_queryset(self):
         return self.queryset.filter(store__user=self.request.user)
@@ -485,13 +705,17 @@ class OrderAdminViewSet(GenericViewSet):
             })
         instance.canceled = True
         instance.save()
+        Product.objects.release(dict(
+            instance.orderposition_set.filter(product__isnull=False).values_list('product_id').annotate(Sum('count'))
+        ))
+        transaction.on_commit(lambda: touch(Product))
         return Response({'detail': 'Заказ успешно отменен'}, status=200)
 
 
 class OrderPositionAdminViewSet(ModelViewSet):
     queryset = OrderPosition.objects.all()
     serializer_class = OrderPositionSerializer
-    pagination_class = StandardPagination
+    pagination_class = KeysetOptionalPagination
     permission_classes = [IsAuthenticated]
     filter_backends = [SearchFilter, OrderingFilter]
     filter_key_fields = ['order', 'product']
@@ -507,10 +731,10 @@ class OrderPositionAdminViewSet(ModelViewSet):
         return super(OrderPositionAdminViewSet, self).filter_queryset(queryset)
 
 
-class ProductAdminViewSet(ModelViewSet):
+class ProductAdminViewSet(EagerLoadingMixin, ModelViewSet):
     queryset = Product.objects.all()
     serializer_class = ProductAdminSerializer
-    pagination_class = StandardPagination
+    pagination_class = KeysetOptionalPagination
     permission_classes = [IsAuthenticated]
     filter_backends = [SearchFilter, OrderingFilter]
     filter_key_fields = ['category', 'store', 'group']
@@ -631,7 +855,7 @@ class ProductAdminViewSet(ModelViewSet):
         })
 
 
-class ProductGroupAdminViewSet(ModelViewSet):
+class ProductGroupAdminViewSet(EagerLoadingMixin, ModelViewSet):
     queryset = ProductGroup.objects.all()
     serializer_class = ProductGroupSerializer
     pagination_class = StandardPagination
@@ -655,6 +879,7 @@ class ProductGroupAdminViewSet(ModelViewSet):
         products_id = request.data.get('products')
         if isinstance(products_id, list):
             instance.product_set.add(*products_id)
+            touch(Product)
         return Response({'detail': f'Товары успешно добавлены в группу "{instance.name}"'}, status=200)
 
     @action(methods=['post'], detail=True)
@@ -663,6 +888,7 @@ class ProductGroupAdminViewSet(ModelViewSet):
         products_id = request.data.get('products')
         if isinstance(products_id, list):
             instance.product_set.remove(*products_id)
+            touch(Product)
         return Response({'detail': f'Товары успешно удалены из группы "{instance.name}"'}, status=200)
 
 
@@ -722,6 +948,43 @@ class StoreAdminViewSet(ModelViewSet):
         queryset = query_params_filter(self.request, queryset, self.filter_key_fields, self.filter_char_fields)
         return super(StoreAdminViewSet, self).filter_queryset(queryset)
 
+    @action(methods=['get'], detail=True)
+    def sales(self, request, pk):
+        """
+        Sales of the store from ?date_from= to ?date_to= (YYYY-MM-DD, the last 30 days by default): totals,
+        days with sales and the ?products= best selling products. Read from the daily rollups (analytics.py).
+        """
+        store = self.get_object()
+        try:
+            date_to = datetime.date.fromisoformat(request.query_params.get('date_to', timezone.localdate().isoformat()))
+            date_from = datetime.date.fromisoformat(
+                request.query_params.get('date_from', (date_to - datetime.timedelta(days=29)).isoformat())
+            )
+        except ValueError:
+            return Response({'detail': 'Даты должны быть заданы в формате ГГГГ-ММ-ДД'}, status=400)
+        try:
+            limit = min(max(int(request.query_params.get('products', 10)), 0), 100)
+        except ValueError:
+            return Response({'detail': 'Количество товаров должно быть целым числом'}, status=400)
+
+        days = StoreSalesDay.objects.filter(store=store, date__gte=date_from, date__lte=date_to)
+        totals = days.aggregate(
+            orders=Sum('orders'), revenue=Sum('revenue'), units=Sum('units'),
+            canceled_orders=Sum('canceled_orders'), delivered_orders=Sum('delivered_orders')
+        )
+        products = ProductSalesDay.objects.filter(store=store, date__gte=date_from, date__lte=date_to).values(
+            'product_id', 'product__name'
+        ).annotate(
+            orders=Sum('orders'), revenue=Sum('revenue'), units=Sum('units'), canceled_units=Sum('canceled_units')
+        ).order_by('-revenue', 'product_id')[:limit]
+        return Response({
+            'date_from': date_from,
+            'date_to': date_to,
+            'totals': StoreSalesSerializer({name: value or 0 for name, value in totals.items()}).data,
+            'days': StoreSalesSerializer(days.order_by('date'), many=True).data,
+            'products': ProductSalesSerializer(products, many=True).data,
+        })
+
 
 class StoreContactAdminViewSet(ModelViewSet):
     queryset = StoreContact.objects.all()
@@ -742,7 +1005,7 @@ class StoreContactAdminViewSet(ModelViewSet):
         return super(StoreContactAdminViewSet, self).filter_queryset(queryset)
 
 
-class DiscountViewSet(ModelViewSet):
+class DiscountViewSet(EagerLoadingMixin, ModelViewSet):
     queryset = Discount.objects.all()
     serializer_class = DiscountSerializer
     pagination_class = StandardPagination
@@ -774,7 +1037,7 @@ class BundleViewSet(ModelViewSet):
         return super(BundleViewSet, self).filter_queryset(queryset)
 
 
-class BundlePositionViewSet(ModelViewSet):
+class BundlePositionViewSet(EagerLoadingMixin, ModelViewSet):
     queryset = BundlePosition.objects.all()
     serializer_class = BundlePositionSerializer
     pagination_class = StandardPagination
@@ -790,7 +1053,7 @@ class BundlePositionViewSet(ModelViewSet):
         return super(BundlePositionViewSet, self).filter_queryset(queryset)
 
 
-class DeliveryCostViewSet(ModelViewSet):
+class DeliveryCostViewSet(EagerLoadingMixin, ModelViewSet):
     queryset = DeliveryCost.objects.all()
     serializer_class = DeliveryCostSerializer
     pagination_class = StandardPagination
@@ -806,7 +1069,7 @@ class DeliveryCostViewSet(ModelViewSet):
         return super(DeliveryCostViewSet, self).filter_queryset(queryset)
 
 
-class BundlePhotoViewSet(ModelViewSet):
+class BundlePhotoViewSet(EagerLoadingMixin, ModelViewSet):
     queryset = BundlePhoto.objects.all()
     serializer_class = BundlePhotoSerializer
     pagination_class = StandardPagination